@@ -5,16 +5,51 @@ __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 index = {"get_norm_stats": "00_utils.ipynb",
          "draw_rect": "00_utils.ipynb",
          "convert_cords": "00_utils.ipynb",
+         "convert_cords_batch": "00_utils.ipynb",
+         "revert_cords_batch": "00_utils.ipynb",
          "resize": "00_utils.ipynb",
+         "letterbox_params": "00_utils.ipynb",
+         "letterbox": "00_utils.ipynb",
+         "letterbox_batch": "00_utils.ipynb",
          "noise": "00_utils.ipynb",
+         "WINDOW_DTYPE": "00_utils.ipynb",
+         "crop_windows": "00_utils.ipynb",
+         "crop_view": "00_utils.ipynb",
          "get_prompt_points": "00_utils.ipynb",
+         "decode_pil": "00_utils.ipynb",
+         "decode_cv2": "00_utils.ipynb",
+         "decode_turbojpeg": "00_utils.ipynb",
+         "decode_simplejpeg": "00_utils.ipynb",
+         "DECODERS": "00_utils.ipynb",
+         "decode_image": "00_utils.ipynb",
+         "image_size": "00_utils.ipynb",
+         "merge_regions": "00_utils.ipynb",
+         "decode_regions": "00_utils.ipynb",
+         "resize_region": "00_utils.ipynb",
+         "benchmark_decoders": "00_utils.ipynb",
          "yolo_to_coco": "00_utils.ipynb",
+         "AnnotationIndex": "01_data.ipynb",
+         "SampleCache": "01_data.ipynb",
+         "SharedImageCache": "01_data.ipynb",
+         "SampleBatch": "01_data.ipynb",
          "PTBDataset": "01_data.ipynb",
+         "build_4ch_batch": "01_data.ipynb",
+         "PTBCollate": "01_data.ipynb",
+         "SizeBucketSampler": "01_data.ipynb",
+         "BatchAugment": "01_data.ipynb",
          "PTBTransform": "01_data.ipynb",
          "PTBImage": "01_data.ipynb",
+         "ShardWriter": "01_data.ipynb",
+         "ConversionManifest": "01_data.ipynb",
+         "AnnotationWriter": "01_data.ipynb",
          "ConversionDataset": "01_data.ipynb",
+         "CropDataset": "01_data.ipynb",
+         "ShardDataset": "01_data.ipynb",
+         "DevicePrefetcher": "02_model.ipynb",
          "EfficientLoc": "02_model.ipynb",
-         "CIoU": "02_model.ipynb"}
+         "CIoU": "02_model.ipynb",
+         "PTBBatchTransform": "03_fastai.ipynb",
+         "ptb_dataloaders": "03_fastai.ipynb"}
 
 modules = ["utils.py",
            "data.py",
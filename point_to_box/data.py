@@ -1,6 +1,8 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/01_data.ipynb (unless otherwise specified).
 
-__all__ = ['PTBDataset', 'PTBTransform', 'PTBImage', 'ConversionDataset']
+__all__ = ['AnnotationIndex', 'SampleCache', 'SharedImageCache', 'SampleBatch', 'PTBDataset', 'build_4ch_batch',
+           'PTBCollate', 'SizeBucketSampler', 'BatchAugment', 'PTBTransform', 'PTBImage', 'ShardWriter',
+           'ConversionManifest', 'AnnotationWriter', 'ConversionDataset', 'CropDataset', 'ShardDataset']
 
 # Cell
 #export
@@ -14,9 +16,21 @@ import numpy as np
 from tqdm import tqdm
 from cv2 import rectangle, circle
 from pycocotools.coco import COCO
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
 from PIL import Image
 import random
+import hashlib
+import warnings
+import io
+import tarfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import threading
+import queue
+import time
+import copy
+from collections import deque
 
 from fastcore.dispatch import typedispatch
 
@@ -25,6 +39,370 @@ from fastai.vision.data import get_grid
 from fastai.torch_core import show_image
 import matplotlib.pyplot as plt
 
+# Cell
+class AnnotationIndex():
+    """Flat array index of a point-to-box style annotation file
+
+    Holds one row per image, sorted by image id, using the first annotation of each image:
+    image ids, widths, heights, file-name offsets into a byte array, boxes [N, 4],
+    prompts [N, 2], category ids and letterbox sizes (-1 if the image is not stored at
+    native resolution, see `ConversionDataset`). All prompt points of an annotation are kept
+    in `prompts` [M, 2], row i owns `prompts[prompt_offsets[i]:prompt_offsets[i+1]]`. Use `AnnotationIndex.load` to cache the arrays
+    on disk and memory-map them on later loads instead of parsing the JSON again.
+
+    **Params**
+
+    arrays : dict of index arrays, keyed by `AnnotationIndex.fields`
+    """
+    fields = ['img_ids', 'widths', 'heights', 'name_offsets', 'names',
+              'bbox', 'prompt', 'category_id', 'letterbox_size', 'prompt_offsets', 'prompts']
+    version = 3
+
+    def __init__(self, arrays, path = None):
+        self.path = path
+        for field in self.fields:
+            setattr(self, field, arrays[field])
+
+    @classmethod
+    def from_json(cls, annos):
+        """Build the index by parsing a coco-style annotation file"""
+        with open(annos) as f:
+            data = json.load(f)
+        imgs = sorted(data['images'], key = lambda img: img['id'])
+        num_imgs = len(imgs)
+        img_pos = {img['id']: i for i, img in enumerate(imgs)}
+
+        bbox = np.full([num_imgs, 4], np.nan)
+        prompt = np.full([num_imgs, 2], np.nan)
+        category_id = np.full(num_imgs, -1, dtype = np.int64)
+        seen = np.zeros(num_imgs, dtype = bool)
+        points = [[] for _ in range(num_imgs)]
+        for anno in data['annotations']:
+            i = img_pos.get(anno['image_id'])
+            # keep the first annotation of every image
+            if i is None or seen[i]: continue
+            seen[i] = True
+            bbox[i] = anno['bbox']
+            point = anno.get('prompt', anno.get('center'))
+            if point is not None: prompt[i] = point
+            points[i] = anno.get('prompts', [] if point is None else [point])
+            category_id[i] = anno['category_id']
+
+        prompt_offsets = np.zeros(num_imgs + 1, dtype = np.int64)
+        prompt_offsets[1:] = np.cumsum([len(pts) for pts in points])
+
+        names = [img['file_name'].encode() for img in imgs]
+        name_offsets = np.zeros(num_imgs + 1, dtype = np.int64)
+        name_offsets[1:] = np.cumsum([len(name) for name in names])
+
+        return cls({
+            'img_ids': np.array([img['id'] for img in imgs], dtype = np.int64),
+            'widths': np.array([img.get('width', -1) for img in imgs], dtype = np.int64),
+            'heights': np.array([img.get('height', -1) for img in imgs], dtype = np.int64),
+            'name_offsets': name_offsets,
+            'names': np.frombuffer(b''.join(names), dtype = np.uint8),
+            'bbox': bbox,
+            'prompt': prompt,
+            'category_id': category_id,
+            'letterbox_size': np.array([img.get('letterbox', {}).get('size', -1) for img in imgs],
+                                       dtype = np.int64),
+            'prompt_offsets': prompt_offsets,
+            'prompts': np.array([pt for pts in points for pt in pts], dtype = np.float64).reshape(-1, 2)})
+
+    @classmethod
+    def cache_path(cls, annos, cache_dir = None):
+        """Cache location keyed by the annotation file path, size, and modification time"""
+        annos = Path(annos)
+        stat = annos.stat()
+        key = f'{cls.version}:{annos.resolve()}:{stat.st_size}:{stat.st_mtime_ns}'
+        key = hashlib.sha1(key.encode()).hexdigest()[:16]
+        cache_dir = Path(cache_dir) if cache_dir else annos.parent/'.ptb_index'
+        return cache_dir/f'{annos.stem}_{key}'
+
+    @classmethod
+    def load(cls, annos, cache_dir = None):
+        """
+        Load the index from its on-disk cache, building and caching it first if necessary
+
+        **Params**
+
+        annos : coco-style annotation file
+
+        cache_dir : optional cache directory, defaults to '.ptb_index' next to `annos`
+        """
+        path = cls.cache_path(annos, cache_dir)
+        if not path.exists():
+            index = cls.from_json(annos)
+            try:
+                index.save(path)
+            # e.g. read-only data dir, keep the in-memory index
+            except OSError:
+                return index
+        return cls.from_cache(path)
+
+    @classmethod
+    def from_cache(cls, path):
+        """Memory-map the index arrays saved in directory `path`"""
+        return cls({field: np.load(Path(path)/f'{field}.npy', mmap_mode = 'r')
+                    for field in cls.fields}, path = path)
+
+    def save(self, path):
+        """Save index arrays as .npy files in directory `path`"""
+        path = Path(path)
+        tmp_path = path.with_name(path.name + f'.tmp{os.getpid()}')
+        tmp_path.mkdir(parents = True, exist_ok = True)
+        for field in self.fields:
+            np.save(tmp_path/f'{field}.npy', getattr(self, field))
+        os.replace(tmp_path, path)
+
+    def file_name(self, idx):
+        return bytes(self.names[self.name_offsets[idx]:self.name_offsets[idx+1]]).decode()
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def __getstate__(self):
+        # cached indices are re-mapped from disk instead of pickling the arrays
+        if self.path is None: return self.__dict__
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        if 'img_ids' in state:
+            self.__dict__.update(state)
+        else:
+            self.__dict__.update(self.from_cache(state['path']).__dict__)
+
+# Cell
+class SampleCache():
+    """Pre-decoded uint8 images stored back to back in one contiguous file
+
+    Images are read as zero-copy slices of a memory-mapped file, or of an
+    in-memory copy of it if `in_memory` is True. The in-memory copy is loaded
+    once into shared memory when the cache is created, so DataLoader workers
+    all read the same pages. The index is stored next to the data file as
+    '<path>.index.npy' with one row per image: [img_id, offset, height, width,
+    channels].
+
+    **Params**
+
+    path : path to the cache data file
+
+    in_memory : optional, load the whole cache into shared RAM instead of memory-mapping it
+    """
+
+    def __init__(self, path, in_memory = False):
+        self.path = Path(path)
+        self.in_memory = in_memory
+        self.index = np.load(self.index_path(self.path))
+        self.data = None
+        self.shared = None
+        if in_memory:
+            self.shared = torch.from_numpy(np.fromfile(self.path, dtype = np.uint8)).share_memory_()
+
+    @staticmethod
+    def index_path(path):
+        return Path(str(path) + '.index.npy')
+
+    @classmethod
+    def exists(cls, path):
+        return Path(path).exists() and cls.index_path(path).exists()
+
+    @classmethod
+    def build(cls, root, fnames, img_ids, path, decode_backend = None):
+        """Decode images once and write them into a cache file
+
+        **Params**
+
+        root : path to image dir
+
+        fnames : list of image file names, in dataset order
+
+        img_ids : list of image ids matching `fnames`
+
+        path : destination path for the cache data file
+
+        decode_backend : optional image decode backend, see `utils.decode_image`
+        """
+        path = Path(path)
+        tmp_path = Path(str(path) + '.tmp')
+        index = np.zeros([len(fnames), 5], dtype = np.int64)
+        offset = 0
+        with open(tmp_path, 'wb') as f:
+            for i, (img_id, fname) in enumerate(tqdm(zip(img_ids, fnames),
+                    total = len(fnames), desc = 'Building sample cache')):
+                img = utils.decode_image(os.path.join(root, fname), backend = decode_backend)
+                img = np.ascontiguousarray(img, dtype = np.uint8)
+                f.write(img.tobytes())
+                index[i] = [img_id, offset, *img.shape]
+                offset += img.nbytes
+        np.save(cls.index_path(path), index)
+        os.replace(tmp_path, path)
+
+    def _open(self):
+        if self.in_memory:
+            self.data = self.shared.numpy()
+        else:
+            self.data = np.memmap(self.path, dtype = np.uint8, mode = 'r')
+
+    def __getitem__(self, idx):
+        # data is opened lazily so each worker process maps the file or views the shared copy itself
+        if self.data is None: self._open()
+        _, offset, h, w, c = self.index[idx]
+        return self.data[offset:offset + h*w*c].reshape(h, w, c)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # never pickle the mapped data, workers re-open the file instead; the shared in-memory
+        # copy is sent to workers as a shared memory handle by the DataLoader
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+# Cell
+class SharedImageCache():
+    """Size-bounded LRU cache of decoded uint8 images in shared memory
+
+    Images are stored in fixed-size slots of shared-memory tensors, so all DataLoader
+    worker processes read and fill the same cache. Create it in the main process before
+    the workers start, and pass it to `PTBDataset` as `shared_cache`.
+
+    Images are keyed by a hash of their file path (`key`), so datasets sharing a cache, e.g. the
+    training and validation set, never read each other's images.
+
+    The cache is set-associative: an image key hashes to one set of `ways` slots, so a lookup
+    only scans that set, and images are evicted least recently used within their set. Sets
+    are guarded by a pool of locks, workers only wait for each other on the same lock.
+
+    **Params**
+
+    capacity : cache size in bytes
+
+    max_img_bytes : optional size of the largest cacheable image in bytes, larger images are
+        not cached and counted as 'oversize'
+
+    mp_context : optional multiprocessing start method of the DataLoader workers, e.g. 'spawn'
+
+    ways : slots per set
+
+    num_locks : max number of locks guarding the sets
+    """
+
+    def __init__(self, capacity, max_img_bytes = 512*512*3, mp_context = None, ways = 8,
+                 num_locks = 64):
+        self.slot_bytes = max_img_bytes
+        num_slots = max(1, int(capacity // max_img_bytes))
+        self.ways = min(ways, num_slots)
+        self.num_sets = num_slots // self.ways
+        self.num_slots = self.num_sets * self.ways
+        self.data = torch.empty([self.num_slots, self.slot_bytes], dtype = torch.uint8).share_memory_()
+        self.keys = torch.full([self.num_slots], -1, dtype = torch.int64).share_memory_()
+        self.shapes = torch.zeros([self.num_slots, 3], dtype = torch.int64).share_memory_()
+        self.last_used = torch.zeros([self.num_slots], dtype = torch.int64).share_memory_()
+        ctx = multiprocessing.get_context(mp_context)
+        self.locks = [ctx.Lock() for _ in range(min(num_locks, self.num_sets))]
+        # per lock: hits, misses, evictions, oversize, access clock
+        self.counters = torch.zeros([len(self.locks), 5], dtype = torch.int64).share_memory_()
+        self._warned = False
+
+    @staticmethod
+    def key(path):
+        """Non-negative 64-bit integer key of an image file path"""
+        digest = hashlib.blake2b(os.path.abspath(path).encode(), digest_size = 8).digest()
+        # -1 marks empty slots
+        return int.from_bytes(digest, 'little') >> 1
+
+    def _set(self, key):
+        """Slot range of the set of image `key` and the index of its lock"""
+        # multiplicative hash spreads consecutive keys over the sets
+        s = (key * 2654435761) % self.num_sets
+        return slice(s*self.ways, (s + 1)*self.ways), s % len(self.locks)
+
+    def get(self, key, out = None):
+        """
+        Look up image `key`, returns a copy of it or None on a miss
+
+        **Params**
+
+        key : integer image key, see `key`
+
+        out : optional array the image is copied into if the shapes match
+        """
+        slots, lock = self._set(key)
+        counters = self.counters.numpy()[lock]
+        with self.locks[lock]:
+            slot = np.flatnonzero(self.keys.numpy()[slots] == key)
+            if len(slot) == 0:
+                counters[1] += 1
+                return None
+            slot = slots.start + slot[0]
+            counters[0] += 1
+            counters[4] += 1
+            self.last_used.numpy()[slot] = counters[4]
+            h, w, c = self.shapes.numpy()[slot]
+            img = self.data.numpy()[slot, :h*w*max(c, 1)]
+            img = img.reshape((h, w, c) if c else (h, w))
+            if out is not None and out.shape == img.shape:
+                np.copyto(out, img)
+                return out
+            return img.copy()
+
+    def put(self, key, img):
+        """Insert image `key`, evicting the least recently used image of its set if the set is full"""
+        slots, lock = self._set(key)
+        counters = self.counters.numpy()[lock]
+        if img.nbytes > self.slot_bytes:
+            with self.locks[lock]:
+                counters[3] += 1
+            if not self._warned:
+                warnings.warn(f'SharedImageCache: images larger than max_img_bytes ({self.slot_bytes}) '
+                              'are not cached, see stats()["oversize"]')
+                self._warned = True
+            return False
+        with self.locks[lock]:
+            keys = self.keys.numpy()[slots]
+            if (keys == key).any():
+                return True
+            empty = np.flatnonzero(keys == -1)
+            if len(empty):
+                slot = slots.start + empty[0]
+            else:
+                slot = slots.start + np.argmin(self.last_used.numpy()[slots])
+                counters[2] += 1
+            counters[4] += 1
+            self.keys.numpy()[slot] = key
+            self.last_used.numpy()[slot] = counters[4]
+            self.shapes.numpy()[slot] = [*img.shape[:2], img.shape[2] if img.ndim == 3 else 0]
+            self.data.numpy()[slot, :img.nbytes] = np.ascontiguousarray(img).reshape(-1)
+        return True
+
+    def stats(self):
+        """Dict of hit, miss, eviction, and oversize counters"""
+        hits, misses, evictions, oversize, _ = self.counters.sum(0).tolist()
+        return {'hits': hits, 'misses': misses, 'evictions': evictions, 'oversize': oversize,
+                'hit_rate': hits / max(hits + misses, 1),
+                'cached': int((self.keys >= 0).sum()), 'slots': self.num_slots}
+
+    def __len__(self):
+        return int((self.keys >= 0).sum())
+
+# Cell
+class SampleBatch(list):
+    """
+    List of samples from `PTBDataset.__getitems__`
+
+    **Params**
+
+    samples : the samples
+
+    imgs : optional uint8 batch buffer [B, H, W, 3] whose rows are the sample images, `PTBCollate`
+        uses it without copying
+    """
+    def __init__(self, samples, imgs = None):
+        super().__init__(samples)
+        self.imgs = imgs
+
 # Cell
 class PTBDataset(Dataset):
     """Point-to-box dataset class compatible with pytorch dataloaders
@@ -41,30 +419,192 @@ class PTBDataset(Dataset):
 
     norm_chnls : optional number of img channels to normalize, required if using tfms
 
+    cache : optional path to a `SampleCache` file, built on first use if it does not exist
+
+    cache_in_memory : optional, load the sample cache into RAM instead of memory-mapping it
+
+    compact : optional, return (uint8 HxWx3 image, prompt (x, y), box [xmin, ymin, w, h])
+        and defer float conversion, normalization, box conversion and the prompt channel
+        to `build_4ch_batch`
+
+    index_dir : optional cache directory for the `AnnotationIndex`
+
+    decode_threads : optional number of threads decoding images in `__getitems__`, 0 decodes serially.
+        Every DataLoader worker starts its own threads
+
+    shared_cache : optional `SharedImageCache` checked before decoding an image
+
+    decode_backend : optional image decode backend, see `utils.decode_image`
+
+    img_size : optional, letterbox every image to this square size at load time, in uint8.
+        Defaults to the size stored for crops converted with `ConversionDataset(native = True)`
+
+    sample_prompt : optional, pick a random prompt per access for annotations with several
+        prompt points (`ConversionDataset(multi_prompt = True)`), otherwise use the first one
+
     """
 
-    def __init__(self, root, annos, box_format = None, tfms = None, norm_chnls=None, ):
+    def __init__(self, root, annos, box_format = None, tfms = None, norm_chnls=None,
+                 cache = None, cache_in_memory = False, compact = False, index_dir = None,
+                 decode_threads = 0, shared_cache = None, decode_backend = None, img_size = None,
+                 sample_prompt = True):
         self.root = root
+        self.sample_prompt = sample_prompt
+        self.compact = compact
+        self.decode_threads = decode_threads
+        self.shared_cache = shared_cache
+        self.decode_backend = decode_backend
+        self._pool, self._pool_pid = None, None
         self.tfms = tfms
         if tfms:
             assert norm_chnls in [3,4], 'Improper channel stats for normalization'
         self.norm_chnls = norm_chnls
-        self.coco = COCO(annos)
-        self.ids = list(sorted(self.coco.imgs.keys()))
+        self.index = AnnotationIndex.load(annos, index_dir)
+        self.ids = self.index.img_ids
+        # per-sample letterbox size, -1 keeps the stored image size
+        if img_size:
+            self.img_sizes = np.full(len(self.ids), img_size, dtype = np.int64)
+        else:
+            self.img_sizes = self.index.letterbox_size
         if box_format:
             assert box_format in ['cntr_ofst', 'cntr_ofst_frac',
                                   'corner_ofst_frac'], 'Improper box format'
         self.box_format = box_format
+        self.cache = None
+        if cache:
+            if not SampleCache.exists(cache):
+                SampleCache.build(self.root,
+                    [self.index.file_name(i) for i in range(len(self.index))],
+                    self.ids, cache, decode_backend = decode_backend)
+            self.cache = SampleCache(cache, in_memory = cache_in_memory)
+            assert np.array_equal(self.cache.index[:,0], self.ids), \
+                'Sample cache does not match annotations'
+
+    def _read_img(self, idx, out = None):
+        """Open input image (or read it from one of the caches) as uint8 np.ndarray"""
+        if self.cache is not None:
+            return self.cache[idx]
+        path = os.path.join(self.root, self.index.file_name(idx))
+        if self.shared_cache is not None:
+            key = self.shared_cache.key(path)
+            img = self.shared_cache.get(key, out = out)
+            if img is not None: return img
+        img = utils.decode_image(path, out = out, backend = self.decode_backend)
+        if self.shared_cache is not None:
+            self.shared_cache.put(key, img)
+        return img
+
+    def _read_into(self, idx, out):
+        """Read image into `out`, returns the image instead if its shape does not match"""
+        img = self._read_img(idx, out)
+        if img is out:
+            return None
+        if img.shape != out.shape:
+            return img
+        np.copyto(out, img)
+        return None
+
+    def _letterbox(self, idx, img, box, prompt):
+        """Letterbox a native resolution sample to its `img_sizes` size, other samples pass through"""
+        size = int(self.img_sizes[idx])
+        if size < 0 or img.shape[:2] == (size, size):
+            return img, box, prompt
+        if torch.is_tensor(img): img = img.numpy()
+        return utils.letterbox(img, size, box, prompt)
+
+    def _prompt(self, idx):
+        """Prompt (x, y) of a sample, a random one of its prompt points if `sample_prompt`"""
+        start, stop = self.index.prompt_offsets[idx], self.index.prompt_offsets[idx+1]
+        if self.sample_prompt and stop - start > 1:
+            return self.index.prompts[random.randrange(start, stop)].tolist()
+        return self.index.prompt[idx].tolist()
+
+    def _load(self, idx):
+        """Load the uint8 image, coco box [xmin, ymin, w, h], and prompt (x, y) for a sample"""
+        return self._letterbox(idx, self._read_img(idx), self.index.bbox[idx].tolist(),
+                               self._prompt(idx))
+
+    def _batch_shape(self, idxs):
+        """Image shape shared by all `idxs`, None if sizes differ or are unknown"""
+        sizes = self.img_sizes[idxs]
+        if len(sizes) > 0 and (sizes >= 0).all():
+            return (int(sizes[0]), int(sizes[0]), 3) if (sizes == sizes[0]).all() else None
+        if self.cache is not None:
+            shapes = self.cache.index[idxs, 2:]
+        else:
+            shapes = np.stack([self.index.heights[idxs], self.index.widths[idxs],
+                               np.full(len(idxs), 3)], axis = 1)
+        if len(shapes) == 0 or (shapes != shapes[0]).any() or (shapes[0] < 0).any():
+            return None
+        return tuple(int(dim) for dim in shapes[0])
+
+    def _map(self, fn, *iterables):
+        """Map `fn` over a thread pool owned by the current process"""
+        if not self.decode_threads:
+            return list(map(fn, *iterables))
+        # threads do not survive fork, DataLoader workers start their own pool
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(self.decode_threads)
+            self._pool_pid = os.getpid()
+        return list(self._pool.map(fn, *iterables))
+
+    def __getitems__(self, idxs):
+        """
+        Load a batch of samples, decoding images on a thread pool into one uint8 batch buffer
+
+        Compact samples are views into the buffer, `PTBCollate` uses it without copying.
+
+        **Params**
+
+        idxs : list of sample indices
+
+        **Returns**
+
+        `SampleBatch` of samples as returned by `__getitem__`, with the batch buffer if the
+        compact sample images are its rows
+        """
+        idxs = np.asarray(idxs, dtype = np.int64)
+        shape = self._batch_shape(idxs)
+        # native resolution crops, letterboxed straight into the batch buffer
+        if shape is not None and (self.img_sizes[idxs] >= 0).all():
+            batch_imgs = torch.empty([len(idxs), *shape], dtype = torch.uint8)
+            _, boxes, prompts = utils.letterbox_batch(
+                self._map(self._read_img, idxs), shape[0], self.index.bbox[idxs],
+                [self._prompt(idx) for idx in idxs], out = batch_imgs.numpy())
+            samples = [self._sample(batch_imgs[i], box, prompt)
+                       for i, (box, prompt) in enumerate(zip(boxes.tolist(), prompts.tolist()))]
+            return SampleBatch(samples, batch_imgs if self.compact else None)
+        batch_imgs, rows = None, []
+        if shape is None:
+            imgs = self._map(self._read_img, idxs)
+        else:
+            batch_imgs = torch.empty([len(idxs), *shape], dtype = torch.uint8)
+            rows = list(batch_imgs)
+            # images with an unexpected shape are returned instead of written
+            imgs = self._map(self._read_into, idxs, batch_imgs.numpy())
+            imgs = [rows[i] if img is None else img for i, img in enumerate(imgs)]
+
+        samples = [self._sample(*self._letterbox(idx, img, self.index.bbox[idx].tolist(),
+                                                 self._prompt(idx)))
+                   for img, idx in zip(imgs, idxs)]
+        # the buffer only holds the batch if every sample image still is its row
+        is_buffer = (self.compact and batch_imgs is not None and
+                     all(sample[0] is row for sample, row in zip(samples, rows)))
+        return SampleBatch(samples, batch_imgs if is_buffer else None)
 
     def __getitem__(self, idx):
-        coco = self.coco
-        img_id = self.ids[idx]
-        ann_ids = coco.getAnnIds(imgIds=img_id)
-        coco_annotation = coco.loadAnns(ann_ids)
-        path = coco.loadImgs(img_id)[0]['file_name']
-
-        # open input image and convert to np.ndarray
-        img = Image.open(os.path.join(self.root, path))
+        return self._sample(*self._load(idx))
+
+    def _sample(self, img, box, prompt):
+        """Build a sample from a uint8 image, coco box, and prompt"""
+        # compact sample, everything else is done batch-wide by build_4ch_batch
+        if self.compact:
+            if not torch.is_tensor(img):
+                img = torch.from_numpy(np.array(img, dtype = np.uint8))
+            return (img, torch.as_tensor(prompt, dtype = torch.float64),
+                    torch.as_tensor(box, dtype = torch.float64))
+
+        if torch.is_tensor(img): img = img.numpy()
         img = np.array(img, dtype = np.float32) / 255.
         imgh, imgw = img.shape[:2]
 
@@ -79,7 +619,7 @@ class PTBDataset(Dataset):
         img_4ch[:,:,:3] = img
 
         # box coords from annotation json
-        xmin, ymin, boxw, boxh = coco_annotation[0]['bbox']
+        xmin, ymin, boxw, boxh = box
 
         # convert box coords
         if self.box_format:
@@ -92,7 +632,7 @@ class PTBDataset(Dataset):
         target = torch.as_tensor(target, dtype = torch.float32)
 
         # object prompt centers for 4th-channel image mask
-        xcntr, ycntr = coco_annotation[0]['prompt']
+        xcntr, ycntr = prompt
 
         # create center mask and change center value to 1
         # np indexing [row, col] => [cntr_y, cntr_x]
@@ -118,99 +658,427 @@ class PTBDataset(Dataset):
     def __len__(self):
         return len(self.ids)
 
+    def __getstate__(self):
+        # thread pools can not be pickled, workers start their own
+        state = self.__dict__.copy()
+        state['_pool'], state['_pool_pid'] = None, None
+        return state
+
 # Cell
-class PTBTransform(Transform):
-    """Point-to-box dataset class compatible with pytorch dataloaders
+def build_4ch_batch(imgs, prompts, boxes, box_format = None, tfms = None, norm_chnls = None, aug = None):
+    """Turn a batch of compact `PTBDataset` samples into 4-channel images and targets
+
+    Float conversion, normalization, box conversion, and the prompt channel are
+    computed once for the whole batch. Results match the per-item `PTBDataset` output.
 
     **Params**
 
-    root : Path to data dir
+    imgs : uint8 image batch [B, H, W, 3]
 
-    annos : annotation json file name
+    prompts : prompt points [B, 2] as (x, y)
+
+    boxes : coco boxes [B, 4] as [xmin, ymin, w, h]
 
     box_format : optional, format for box cord conversion
 
-    tfms : optional, image transforms
+    tfms : optional, image transforms, must accept batched [B, C, H, W] tensors
 
     norm_chnls : optional number of img channels to normalize, required if using tfms
 
+    aug : optional `BatchAugment`, applied to images, boxes, and prompts before normalization
+
+    **Returns**
+
+    img_4ch : float32 image batch [B, 4, H, W]
+
+    target : float32 box batch [B, 4]
     """
+    if tfms:
+        assert norm_chnls in [3,4], 'Improper channel stats for normalization'
+    bs, imgh, imgw = imgs.shape[:3]
 
-    def __init__(self, root, annos, box_format = None, tfms = None, norm_chnls=None, ):
-        self.root = root
-        self.tfms = tfms
+    # float conversion straight into the 4-channel batch
+    img_4ch = torch.zeros([bs, 4, imgh, imgw], dtype = torch.float32, device = imgs.device)
+    img_4ch[:,:3] = imgs.permute(0, 3, 1, 2)
+    img_4ch[:,:3] /= 255.
+
+    # box coords, converted in float64 like the per-item path
+    boxes = torch.as_tensor(boxes, dtype = torch.float64)
+
+    # augment image, box, and prompt together before the prompt channel is drawn
+    if aug:
+        img_4ch[:,:3], boxes, prompts = aug(img_4ch[:,:3], boxes, prompts)
+
+    # 3-channel image transforms
+    if tfms and norm_chnls == 3:
+        img_4ch[:,:3] = tfms(img_4ch[:,:3])
+
+    # prompt channel, truncate cords like int() in the per-item path
+    prompts = torch.as_tensor(prompts).to(device = imgs.device, dtype = torch.int64)
+    img_4ch[torch.arange(bs, device = imgs.device), 3, prompts[:,1], prompts[:,0]] = 1
+
+    # 4-channel image transforms
+    if tfms and norm_chnls == 4:
+        img_4ch = tfms(img_4ch)
+
+    if box_format:
+        boxes = utils.convert_cords_batch(boxes, (imgw, imgh), box_format)
+    target = boxes.to(device = imgs.device, dtype = torch.float32)
+
+    return img_4ch, target
+
+# Cell
+class PTBCollate():
+    """Batch collation for compact `PTBDataset` samples
+
+    Stacks the uint8 images into one preallocated batch tensor and builds the 4-channel
+    batch and targets with `build_4ch_batch`. Can be passed to a DataLoader as `collate_fn`
+    or applied to an already collated (imgs, prompts, boxes) batch in the main process,
+    e.g. to do the float work on the GPU.
+
+    **Params**
+
+    box_format : optional, format for box cord conversion
+
+    tfms : optional, image transforms, must accept batched [B, C, H, W] tensors
+
+    norm_chnls : optional number of img channels to normalize, required if using tfms
+
+    device : optional device the uint8 batch is moved to before float conversion
+
+    aug : optional `BatchAugment`, use for the training collate only
+
+    pad_multiple : optional, pad the batch height and width up to a multiple of this,
+        use the `bucket_step` of a `SizeBucketSampler`. Images of different sizes are
+        always zero-padded at the bottom/right to the largest one in the batch.
+    """
+
+    def __init__(self, box_format = None, tfms = None, norm_chnls = None, device = None, aug = None,
+                 pad_multiple = None):
         if tfms:
             assert norm_chnls in [3,4], 'Improper channel stats for normalization'
+        self.box_format = box_format
+        self.tfms = tfms
         self.norm_chnls = norm_chnls
-        self.coco = COCO(annos)
-        self.ids = list(sorted(self.coco.imgs.keys()))
+        self.device = device
+        self.aug = aug
+        self.pad_multiple = pad_multiple
+
+    def batch_shape(self, imgs):
+        """Padded (h, w) for a list of HxWx3 images"""
+        h = max(img.shape[0] for img in imgs)
+        w = max(img.shape[1] for img in imgs)
+        if self.pad_multiple:
+            h = -(-h // self.pad_multiple) * self.pad_multiple
+            w = -(-w // self.pad_multiple) * self.pad_multiple
+        return h, w
+
+    def stack(self, batch):
+        """Stack a list of compact samples into (imgs, prompts, boxes) batch tensors"""
+        imgs, prompts, boxes = zip(*batch)
+        h, w = self.batch_shape(imgs)
+        # images from `PTBDataset.__getitems__` can already be the rows of one batch buffer
+        buf = getattr(batch, 'imgs', None)
+        if buf is not None and buf.shape[1:3] == (h, w):
+            return buf, torch.stack(prompts), torch.stack(boxes)
+        # box and prompt pixel cords stay valid with the image in the top left corner
+        padded = any(img.shape[:2] != (h, w) for img in imgs)
+        batch_imgs = (torch.zeros if padded else torch.empty)([len(imgs), h, w, 3], dtype = torch.uint8)
+        for i, img in enumerate(imgs):
+            batch_imgs[i, :img.shape[0], :img.shape[1]] = img
+        return batch_imgs, torch.stack(prompts), torch.stack(boxes)
+
+    def __call__(self, batch):
+        # list of samples from a DataLoader, otherwise an already collated batch
+        if not torch.is_tensor(batch[0]):
+            batch = self.stack(batch)
+        imgs, prompts, boxes = batch
+        if self.device is not None:
+            imgs = imgs.to(self.device, non_blocking = True)
+        return build_4ch_batch(imgs, prompts, boxes, box_format = self.box_format,
+                               tfms = self.tfms, norm_chnls = self.norm_chnls, aug = self.aug)
+
+# Cell
+class SizeBucketSampler(Sampler):
+    """Batch sampler that groups samples of similar size
+
+    Sizes come from the annotation `images` entries (`width`, `height`), no image is decoded.
+    Sizes are rounded up to a multiple of `bucket_step` and every batch is drawn from a single
+    bucket, so `PTBCollate(pad_multiple = bucket_step)` pads each batch only to its bucket size.
+
+    **Params**
+
+    sizes : a `PTBDataset` or [N, 2] array of sample (width, height)
+
+    batch_size : number of samples per batch
+
+    bucket_step : bucket granularity in pixels
+
+    shuffle : optional, shuffle samples within buckets and the order of batches
+
+    drop_last : optional, drop the last incomplete batch of each bucket
+
+    seed : optional base seed, the shuffle of an epoch depends on seed and `set_epoch`
+    """
+
+    def __init__(self, sizes, batch_size, bucket_step = 32, shuffle = True,
+                 drop_last = False, seed = 0):
+        if isinstance(sizes, PTBDataset):
+            sizes = np.stack([sizes.index.widths, sizes.index.heights], axis = 1)
+        sizes = np.asarray(sizes, dtype = np.int64)
+        assert (sizes > 0).all(), 'Sizes missing from annotations'
+        self.batch_size = batch_size
+        self.bucket_step = bucket_step
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        # bucket key: padded (w, h)
+        keys = -(-sizes // bucket_step) * bucket_step
+        self.keys, inverse = np.unique(keys, axis = 0, return_inverse = True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind = 'stable')
+        self.buckets = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = rng.permutation(bucket)
+            stop = len(bucket) - len(bucket) % self.batch_size if self.drop_last else len(bucket)
+            batches.extend(bucket[i:i + self.batch_size].tolist()
+                           for i in range(0, stop, self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        # consecutive epochs differ even without set_epoch
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(b) // self.batch_size for b in self.buckets)
+        return sum(-(-len(b) // self.batch_size) for b in self.buckets)
+
+# Cell
+class BatchAugment():
+    """Geometry-aware augmentation of a whole batch of images, boxes, and prompt points
+
+    Flips and scale/translate jitter are combined into one affine transform per sample and
+    applied to the batch with a single `grid_sample`, the same transform is applied to the
+    boxes and prompts. Scale and translation are limited so the box stays inside the image.
+    Color jitter (brightness, contrast, saturation) only touches the RGB channels.
+
+    **Params**
+
+    flip_p : probability of a horizontal flip
+
+    vflip_p : probability of a vertical flip
+
+    scale : max relative scale jitter, scale is sampled from [1 - scale, 1 + scale]
+
+    translate : max translation jitter as a fraction of the image size
+
+    brightness : max brightness jitter factor
+
+    contrast : max contrast jitter factor
+
+    saturation : max saturation jitter factor
+
+    generator : optional torch.Generator for reproducible augmentation. Inside DataLoader
+        workers it is reseeded once per worker from its seed and the worker's `seed`, so workers
+        draw different augmentations
+    """
+
+    def __init__(self, flip_p = 0.5, vflip_p = 0., scale = 0.1, translate = 0.1,
+                 brightness = 0.2, contrast = 0.2, saturation = 0.2, generator = None):
+        self.flip_p = flip_p
+        self.vflip_p = vflip_p
+        self.scale = scale
+        self.translate = translate
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.generator = generator
+        # process the generator was reseeded for
+        self._worker_pid = None
+
+    def worker_generator(self):
+        """`generator`, reseeded once in every DataLoader worker process"""
+        info = get_worker_info()
+        if self.generator is not None and info is not None and self._worker_pid != os.getpid():
+            seed = hash((self.generator.initial_seed(), info.seed)) % 2**63
+            self.generator = torch.Generator().manual_seed(seed)
+            self._worker_pid = os.getpid()
+        return self.generator
+
+    def rand(self, *shape, device = None):
+        """Uniform [0, 1) samples, float64 on `device`"""
+        return torch.rand(*shape, generator = self.worker_generator(), dtype = torch.float64).to(device)
+
+    def params(self, boxes, imgw, imgh):
+        """Sample per-sample flip signs, scales, and translations (pixels) for coco `boxes`"""
+        bs, device = len(boxes), boxes.device
+        size = torch.tensor([imgw, imgh], dtype = torch.float64, device = device)
+        flip = torch.ones([bs, 2], dtype = torch.float64, device = device)
+        flip[self.rand(bs, device = device) < self.flip_p, 0] = -1
+        flip[self.rand(bs, device = device) < self.vflip_p, 1] = -1
+
+        # uniform scale, capped so the box still fits the image
+        scale = 1 + self.scale*(2*self.rand(bs, device = device) - 1)
+        max_scale = (size/boxes[:,2:].clamp(min = 1)).min(1).values
+        scale = torch.minimum(scale, max_scale.clamp(min = 1))
+
+        # box extent after flip and scale around the image center, then a translation
+        # range that keeps it in the image
+        cntr = size/2
+        lo = self.apply_pts(boxes[:,:2], flip, scale, 0, cntr)
+        hi = self.apply_pts(boxes[:,:2] + boxes[:,2:], flip, scale, 0, cntr)
+        lo, hi = torch.minimum(lo, hi), torch.maximum(lo, hi)
+        t_lo = torch.maximum(-lo, -self.translate*size)
+        t_hi = torch.minimum(size - hi, self.translate*size)
+        shift = t_lo + self.rand(bs, 2, device = device)*(t_hi - t_lo)
+        shift = torch.where(t_hi >= t_lo, shift, torch.zeros_like(shift))
+        return flip, scale, shift
+
+    @staticmethod
+    def apply_pts(pts, flip, scale, shift, cntr):
+        """Map pixel points [B, 2] through the per-sample affine transform"""
+        return (pts - cntr)*flip*scale[:,None] + cntr + shift
+
+    def color(self, imgs):
+        """Jitter brightness, contrast, and saturation of RGB [B, 3, H, W] images in [0, 1]"""
+        bs, device = len(imgs), imgs.device
+        fac = lambda m: (1 + m*(2*self.rand(bs, device = device) - 1)).to(imgs.dtype)[:,None,None,None]
+        gray = lambda x: (0.299*x[:,0] + 0.587*x[:,1] + 0.114*x[:,2])[:,None]
+        if self.brightness:
+            imgs = imgs*fac(self.brightness)
+        if self.contrast:
+            mean = gray(imgs).mean((2, 3), keepdim = True)
+            imgs = mean + (imgs - mean)*fac(self.contrast)
+        if self.saturation:
+            g = gray(imgs)
+            imgs = g + (imgs - g)*fac(self.saturation)
+        return imgs.clamp(0, 1)
+
+    def __call__(self, imgs, boxes, prompts = None, box_format = None):
+        """
+        Augment a batch
+
+        **Params**
+
+        imgs : float image batch [B, C, H, W], RGB in [0, 1] in the first 3 channels
+
+        boxes : box batch [B, 4] in `box_format`
+
+        prompts : prompt points [B, 2] as (x, y), if None read from the 4th image channel
+
+        box_format : optional, format of `boxes`
+
+        **Returns**
+
+        imgs, boxes, prompts : augmented batch, boxes in `box_format`
+        """
+        bs, chnls, imgh, imgw = imgs.shape
+        device = imgs.device
+        from_chnl = prompts is None
+        if from_chnl:
+            assert chnls == 4, 'Prompts required for images without a prompt channel'
+            idx = imgs[:,3].flatten(1).argmax(1)
+            prompts = torch.stack([idx % imgw, idx // imgw], 1)
+        boxes = torch.as_tensor(boxes)
+        out_dtype, out_device = boxes.dtype, boxes.device
+        boxes = boxes.to(device = device, dtype = torch.float64)
         if box_format:
-            assert box_format in ['cntr_ofst', 'cntr_ofst_frac',
-                                  'corner_ofst_frac'], 'Improper box format'
-        self.box_format = box_format
+            boxes = utils.revert_cords_batch(boxes, (imgw, imgh), box_format)
+        pts = torch.as_tensor(prompts).to(device = device, dtype = torch.float64)
+        # a prompt pixel index stands for the pixel center
+        if from_chnl: pts = pts + 0.5
+
+        flip, scale, shift = self.params(boxes, imgw, imgh)
+        size = torch.tensor([imgw, imgh], dtype = torch.float64, device = device)
+        cntr = size/2
+
+        # output -> input sampling grid in normalized cords
+        theta = torch.zeros([bs, 2, 3], dtype = torch.float64, device = device)
+        theta[:,0,0] = 1/(flip[:,0]*scale)
+        theta[:,1,1] = 1/(flip[:,1]*scale)
+        theta[:,:,2] = -(shift/cntr)/(flip*scale[:,None])
+        grid = torch.nn.functional.affine_grid(theta, list(imgs.shape), align_corners = False).to(imgs.dtype)
+        src = imgs[:,:3] if from_chnl else imgs
+        warped = torch.nn.functional.grid_sample(src, grid, mode = 'bilinear',
+                                                 padding_mode = 'zeros', align_corners = False)
+
+        # boxes and prompts through the same transform
+        lo = self.apply_pts(boxes[:,:2], flip, scale, shift, cntr)
+        hi = self.apply_pts(boxes[:,:2] + boxes[:,2:], flip, scale, shift, cntr)
+        lo, hi = torch.minimum(lo, hi).clamp(min = 0), torch.maximum(lo, hi)
+        hi = torch.minimum(hi, size)
+        boxes = torch.cat([lo, hi - lo], 1)
+        pts = self.apply_pts(pts, flip, scale, shift, cntr)
+        pts = torch.minimum(pts.clamp(min = 0), size - 1)
+
+        out = imgs.clone() if from_chnl else warped
+        if from_chnl:
+            out[:,:3] = warped
+            # redraw the prompt channel at the new point
+            plane = imgs[:,3]
+            out[:,3] = plane.flatten(1).min(1).values[:,None,None]
+            p = pts.long()
+            out[torch.arange(bs, device = device), 3, p[:,1], p[:,0]] = plane.flatten(1).max(1).values
+        out[:,:3] = self.color(out[:,:3])
 
-    def encodes(self, idx):
-        coco = self.coco
-        img_id = self.ids[idx]
-        ann_ids = coco.getAnnIds(imgIds=img_id)
-        coco_annotation = coco.loadAnns(ann_ids)
-        path = coco.loadImgs(img_id)[0]['file_name']
-
-        # open input image and convert to np.ndarray
-        img = Image.open(os.path.join(self.root, path))
-        img = np.array(img, dtype = np.float32) / 255.
-        imgh, imgw = img.shape[:2]
+        if box_format:
+            boxes = utils.convert_cords_batch(boxes, (imgw, imgh), box_format)
+        boxes = boxes.to(device = out_device, dtype = out_dtype)
+        prompts = pts.to(prompts.dtype) if torch.is_tensor(prompts) else pts
+        return out, boxes, prompts
 
-        # 3-channel image transforms
-        if self.tfms and self.norm_chnls == 3:
-            img = self.tfms(torch.as_tensor(
-                    img, dtype = torch.float32).permute(2,0,1))
-            img = img.permute(1, 2, 0).numpy()
+# Cell
+class PTBTransform(Transform):
+    """Point-to-box fastai item transform, loads samples through `PTBDataset`
 
-        # new 4-channel array
-        img_4ch = np.zeros([imgh, imgw, 4], dtype = np.float32)
-        img_4ch[:,:,:3] = img
+    **Params**
 
-        # box coords from annotation json
-        xmin, ymin, boxw, boxh = coco_annotation[0]['bbox']
+    root : Path to data dir
 
-        # convert box coords
-        if self.box_format:
-            target = utils.convert_cords([xmin, ymin, boxw, boxh],
-                                         [imgw, imgh], self.box_format)
-        # no box cord conversion
-        else:
-             target = [xmin, ymin, boxw, boxh]
+    annos : annotation json file name
 
-        target = torch.as_tensor(target, dtype = torch.float32)
+    box_format : optional, format for box cord conversion
 
-        # object prompt centers for 4th-channel image mask
-        xcntr, ycntr = coco_annotation[0]['center']
+    tfms : optional, image transforms
 
-        # create center mask and change center value to 1
-        # np indexing [row, col] => [cntr_y, cntr_x]
-        cntr_mask = np.zeros([int(imgh),int(imgw)], dtype = np.float32)
-        cntr_mask[int(ycntr)][int(xcntr)] = 1
+    norm_chnls : optional number of img channels to normalize, required if using tfms
 
-        # add mask to img as 4th channel
-        img_4ch[:,:,-1] = cntr_mask
-        img_4ch = torch.as_tensor(img_4ch, dtype = torch.float32)
+    index_dir : optional cache directory for the `AnnotationIndex`
 
-        # re-order image sequence
-        # from: [w, h, c]
-        # to  : [c, w, h]
-        img_4ch = img_4ch.permute(2,0,1)
+    compact : optional, return compact uint8 samples for batch-wide processing,
+        see `point_to_box.fastai.PTBBatchTransform`
 
-        # 4-channel image transforms
-        if self.tfms and self.norm_chnls == 4:
-            img_4ch = self.tfms(img_4ch)
-#             img = img.permute(1, 2, 0).numpy()
+    decode_backend : optional image decode backend, see `utils.decode_image`
 
-        return PTBImage((img_4ch, target))
+    img_size : optional, letterbox every image to this square size, see `PTBDataset`
+
+    """
 
+    def __init__(self, root, annos, box_format = None, tfms = None, norm_chnls=None,
+                 index_dir = None, compact = False, decode_backend = None, img_size = None):
+        self.ds = PTBDataset(root, annos, box_format = box_format, tfms = tfms,
+                             norm_chnls = norm_chnls, index_dir = index_dir,
+                             compact = compact, decode_threads = 0,
+                             decode_backend = decode_backend, img_size = img_size)
+        self.ids = self.ds.ids
+
+    def encodes(self, idx):
+        sample = self.ds[idx]
+        return sample if self.ds.compact else PTBImage(sample)
 
     def __len__(self):
-        return len(self.ids)
+        return len(self.ds)
 
 # Cell
 class PTBImage(tuple):
@@ -256,37 +1124,338 @@ def show_batch(x:PTBImage, y, samples, ctxs = None, max_n = 6,
         type(x[0])
         for i, ctx in enumerate(ctxs): PTBImage((x[0][i], x[1][i])).show(ctx = ctx)
 
+# Cell
+class ShardWriter():
+    """
+    Append samples to fixed-size tar shards in write order
+
+    Every sample is stored as consecutive `<key>.<ext>` image and `<key>.json` members. A shard is
+    written to a temporary file and renamed when full, so readers never see partial shards.
+
+    **Params**
+
+    dst : output directory
+
+    max_count : max number of samples per shard
+
+    max_bytes : optional max encoded image bytes per shard
+
+    prefix : shard file name prefix, shards are named `<prefix>-000000.tar`, ...
+    """
+    def __init__(self, dst, max_count = 10000, max_bytes = None, prefix = 'shard'):
+        self.dst = Path(dst)
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.shard_idx = 0
+        self.tar, self.count, self.size = None, 0, 0
+        self.shards = []
+
+    @property
+    def shard_name(self):
+        return f'{self.prefix}-{self.shard_idx:06d}.tar'
+
+    def _add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def write(self, key, img_bytes, record, ext = 'jpg'):
+        """Append encoded image bytes and its json-serializable annotation record, returns the shard name"""
+        if self.tar is not None and (self.count >= self.max_count or
+                (self.max_bytes and self.size + len(img_bytes) > self.max_bytes)):
+            self.close()
+        if self.tar is None:
+            self.dst.mkdir(parents = True, exist_ok = True)
+            self.tar = tarfile.open(self.dst/(self.shard_name + '.tmp'), 'w')
+        self._add(f'{key}.{ext}', img_bytes)
+        self._add(key + '.json', json.dumps(record).encode())
+        self.count += 1
+        self.size += len(img_bytes)
+        return self.shard_name
+
+    def close(self):
+        """Finish the current shard"""
+        if self.tar is None:
+            return
+        self.tar.close()
+        os.replace(self.dst/(self.shard_name + '.tmp'), self.dst/self.shard_name)
+        self.shards.append(self.shard_name)
+        self.shard_idx += 1
+        self.tar, self.count, self.size = None, 0, 0
+
+    def resume(self):
+        """Continue after the finished shards in `dst`, dropping partial shards of an interrupted run"""
+        for tmp in self.dst.glob(f'{self.prefix}-*.tar.tmp'):
+            tmp.unlink()
+        done = [int(shard.stem.split('-')[-1]) for shard in self.dst.glob(f'{self.prefix}-*.tar')]
+        self.shard_idx = max(done) + 1 if done else 0
+
+# Cell
+class ConversionManifest():
+    """
+    Append-only log of the source images a `ConversionDataset` run has finished
+
+    The first line holds the conversion parameters and their hash, every further line the
+    id and signature of one finished source image and the annotation entries of its crops.
+    Later lines for the same source image replace earlier ones. Entries of crops written
+    to a tar shard are held back until the shard is finished, crop files are only given
+    their final names once their line is written, see `ConversionDataset.add_crops`.
+
+    **Params**
+
+    path : manifest file path
+
+    params : json-serializable dict of the conversion parameters
+    """
+    def __init__(self, path, params):
+        self.path = Path(path)
+        self.params = params
+        self.params_hash = hashlib.sha1(json.dumps(params, sort_keys = True).encode()).hexdigest()
+        self.file = None
+        self.pending = []
+
+    def lines(self):
+        """Stream the source image lines, including replaced ones, nothing if there is no manifest yet"""
+        if not self.path.exists() or self.path.stat().st_size == 0:
+            return
+        with open(self.path) as f:
+            header = json.loads(f.readline())
+            assert header['params_hash'] == self.params_hash, \
+                f'{self.path} was written with different conversion parameters: {header["params"]}'
+            for line in f:
+                # the last line can be cut off by a crash
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    break
+
+    def truncate(self, block_size = 1 << 16):
+        """Drop a last line cut off by a crash, reading the file backwards from its end"""
+        with open(self.path, 'rb+') as f:
+            stop = f.seek(0, os.SEEK_END)
+            while stop > 0:
+                start = max(stop - block_size, 0)
+                f.seek(start)
+                end = f.read(stop - start).rfind(b'\n')
+                if end >= 0:
+                    f.truncate(start + end + 1)
+                    return
+                stop = start
+            f.truncate(0)
+
+    def open(self, resume = False):
+        """Open for appending, a new manifest starts with the header line"""
+        if resume and self.path.exists():
+            self.truncate()
+            if self.path.stat().st_size > 0:
+                self.file = open(self.path, 'a')
+                return
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        self.file = open(self.path, 'w')
+        self._write({'params': self.params, 'params_hash': self.params_hash})
+
+    def _write(self, line):
+        self.file.write(json.dumps(line) + '\n')
+        self.file.flush()
+
+    def add(self, src_id, src_sig, crops, shards = ()):
+        """Log a finished source image, once all `shards` its crops were written to are finished"""
+        self.pending.append(({'src_id': src_id, 'src_sig': src_sig, 'crops': crops}, set(shards)))
+
+    def flush(self, done_shards = ()):
+        """Write the pending lines whose shards are all in `done_shards`"""
+        done_shards = set(done_shards)
+        ready = [line for line, shards in self.pending if shards <= done_shards]
+        self.pending = [(line, shards) for line, shards in self.pending if not shards <= done_shards]
+        for line in ready:
+            self._write(line)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+# Cell
+class AnnotationWriter():
+    """
+    Stream the annotation entries of converted crops to a JSON Lines file
+
+    Entries are appended as crops are saved instead of being held in memory, `write_coco`
+    assembles COCO-style JSON from the file one image and annotation at a time.
+
+    **Params**
+
+    path : entries file path
+
+    multi_prompt : entries hold all prompt points of their crop, see `ConversionDataset`
+    """
+    def __init__(self, path, multi_prompt = False):
+        self.path = Path(path)
+        self.multi_prompt = multi_prompt
+        self.file = None
+        self.count = 0
+
+    def open(self, append = False):
+        """Open for writing, a new file replaces the entries of an earlier run"""
+        self.close()
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        self.file = open(self.path, 'a' if append else 'w')
+        if not append:
+            self.count = 0
+
+    def write(self, entry):
+        """Append one json-serializable annotation entry"""
+        if self.file is None:
+            self.open(append = self.count > 0)
+        self.file.write(json.dumps(entry) + '\n')
+        self.count += 1
+
+    def __iter__(self):
+        if self.file is not None:
+            self.file.flush()
+        if not self.path.exists():
+            return
+        with open(self.path) as f:
+            for line in f:
+                yield json.loads(line)
+
+    def __len__(self):
+        return self.count
+
+    def coco_records(self, entry):
+        """COCO-style image and annotation dicts of an entry"""
+        w, h = entry['img_dims']
+        image = {'license': 0, 'file_name': entry['img_names'], 'width': w, 'height': h,
+                 'id': entry['img_ids']}
+        if entry['letterboxes'] is not None:
+            image['letterbox'] = entry['letterboxes']
+        prompt = entry['prompts']
+        annotation = {'image_id': entry['img_ids'], 'id': entry['anno_ids'],
+                      'bbox': entry['box_annos'], 'area': entry['areas'],
+                      'prompt': prompt[0] if self.multi_prompt else prompt,
+                      'category_id': entry['cat_ids'], 'iscrowd': 0}
+        if self.multi_prompt:
+            annotation['prompts'] = prompt
+        return image, annotation
+
+    def write_coco(self, path, info, licenses, categories, keep = None, root = None):
+        """
+        Write the entries as COCO-style JSON without loading them all into memory
+
+        **Params**
+
+        path : output json file path
+
+        info, licenses, categories : sections of the COCO-style JSON
+
+        keep : optional function of an entry, only entries it returns True for are written
+
+        root : optional directory the image file names are made relative to, e.g. a partition
+        """
+        Path(path).parent.mkdir(parents = True, exist_ok = True)
+        with open(path, 'w') as f:
+            f.write(f'{{"info": {json.dumps(info)}, "licenses": {json.dumps(licenses)}')
+            # one pass over the entries per section
+            for i, section in enumerate(['images', 'annotations']):
+                f.write(f', "{section}": [')
+                sep = ''
+                for entry in self:
+                    if keep is None or keep(entry):
+                        record = self.coco_records(entry)[i]
+                        if root is not None and section == 'images':
+                            record['file_name'] = os.path.relpath(record['file_name'], root)
+                        f.write(sep + json.dumps(record))
+                        sep = ', '
+                f.write(']')
+            f.write(f', "categories": {json.dumps(categories)}}}')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
 # Cell
 class ConversionDataset():
     """
     Class to convert coco-style datasets and annotations into point-to-box style datasets and annotations
 
-    **Params**
+    **Params**
+
+    data_path : path to data directory as Pathlib object
+
+    anno_fname : name of coco-style JSON annotation file
+
+    dst_path : destination path for new dataset and annotation file
+
+    crop_size : size of the square crops taken from the original images
+
+    crop_noise : percentage of possible crop size noise
+
+    resize : bool indicating whether to resize cropped images
+
+    img_size : size of new images is 'resize' is True
+
+    box_noise : percentage of possible box noise
+
+    n : number of samples to create form each object
+
+    prompt_format : from for object prompt point creation, poly or box
+
+    decode_backend : optional image decode backend, see `utils.decode_image`
+
+    shard_size : optional, write crops and their annotation records into tar shards of this
+        many samples instead of one file per crop, see `ShardWriter` and `ShardDataset`
+
+    native : optional, store crops at native resolution together with their letterbox
+        parameters for `img_size` instead of resizing them, datasets letterbox them at load time
+
+    multi_prompt : optional, store one crop per object with all `n` prompt points in its
+        annotation ('prompts') instead of one crop per prompt point, datasets pick one per access
 
-    data_path : path to data directory as Pathlib object
+    img_format : output image format, 'JPEG', 'PNG' or 'WEBP'
 
-    anno_fname : name of coco-style JSON annotation file
+    quality : optional encoder quality for JPEG and WebP, Pillow's default if None
 
-    dst_path : destination path for new dataset and annotation file
+    val_pct : optional, write crops straight into 'train' and 'val' partition directories,
+        this fraction of them into 'val', see `partition`
 
-    crop_size : size of the square crops taken from the original images
+    split_by : hash key of the partition, 'src' keeps all crops of a source image in one
+        partition, 'crop' assigns every output image on its own
 
-    crop_noise : percentage of possible crop size noise
+    split_seed : salt of the partition hash, change it for a different split
 
-    resize : bool indicating whether to resize cropped images
+    node_index, num_nodes : optional, convert only every `num_nodes`-th source image starting
+        at `node_index`, for a conversion spread over nodes sharing `dst_path`. Every node writes
+        below its own 'node-<index>' sub directory and its own annotation files, see `merge_nodes`
 
-    img_size : size of new images is 'resize' is True
+    roi_decode : optional, plan the crops of an image from its header and annotations first and
+        decode only what they need: just the merged crop regions when they cover less than `roi_frac`
+        of the image, and at 1/2, 1/4 or 1/8 scale (JPEG DCT scaling) when every crop still keeps
+        at least `img_size` pixels across and is resized anyway. Region decoding needs the
+        'turbojpeg' `decode_backend`, reduced-scale decoding 'turbojpeg' or Pillow. Crop windows,
+        prompts and boxes are the same as without it. Crop pixels differ by a mean of at most 1
+        gray level at full scale, reduced-scale crops are low-pass filtered by the DCT scaling and
+        differ by at most about 2*scale on natural images, most with 4:1:1 and 4:4:1 chroma
+        subsampling, see `decode_plan`, `utils.decode_regions` and `utils.resize_region`
 
-    box_noise : percentage of possible box noise
+    roi_frac : max fraction of the image area the crop regions may cover for region decoding
 
-    n : number of samples to create form each object
+    max_decode_scale : max downscale factor of reduced-scale decoding, 1 turns it off
 
-    prompt_format : from for object prompt point creation, poly or box
+    roi_max_regions : max number of merged regions for region decoding, more are decoded whole
     """
+    # file extensions of the supported output image formats
+    img_exts = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+
     def __init__(self, data_path, anno_fname, dst_path,
                  crop_size = 100, crop_noise = 0.1, resize = True,
                  img_size = 512, box_noise = 0.2, n = 1,
-                 prompt_format = 'poly', new_anno_fname = None):
+                 prompt_format = 'poly', new_anno_fname = None, decode_backend = None,
+                 shard_size = None, native = False, multi_prompt = False,
+                 img_format = 'JPEG', quality = None, val_pct = 0.0, split_by = 'src',
+                 split_seed = 0, node_index = 0, num_nodes = 1, roi_decode = False, roi_frac = 0.5,
+                 max_decode_scale = 8, roi_max_regions = 16):
         # inputs for dataset processing
         self.data = data_path
         self.annos = anno_fname
@@ -300,23 +1469,52 @@ class ConversionDataset():
         self.box_noise = box_noise
         self.n = n
         self.prompt_format = prompt_format
+        self.decode_backend = decode_backend
+        self.native = native
+        self.multi_prompt = multi_prompt
+        assert img_format in self.img_exts, 'Improper image format'
+        self.img_format = img_format
+        self.img_ext = self.img_exts[img_format]
+        self.quality = quality
+        self.roi_decode = roi_decode
+        self.roi_frac = roi_frac
+        self.max_decode_scale = max_decode_scale
+        self.roi_max_regions = roi_max_regions
+        assert split_by in ['src', 'crop'], 'Improper split key'
+        self.val_pct = val_pct
+        self.split_by = split_by
+        self.split_seed = split_seed
         if new_anno_fname is None:
             self.new_annos = 'individual_'+ self.annos
         else:
             self.new_annos = new_anno_fname
 
+        assert 0 <= node_index < num_nodes, 'Improper node index'
+        self.node_index = node_index
+        self.num_nodes = num_nodes
+        # annotation file name of the merged output of all nodes
+        self.merged_annos = self.new_annos
+        self.node_dir = ''
+        if num_nodes > 1:
+            self.node_dir = f'node-{node_index:04d}'
+            self.new_annos = self.node_annos(node_index)
+
+        # output sub directories, the dataset root without partitions, created by `make_dirs`
+        self.partitions = ['train', 'val'] if val_pct > 0 else ['']
+        # one `ShardWriter` per partition
+        self.shard_size = shard_size
+        self.shards = {part: ShardWriter(self.dst/part/self.node_dir, max_count = shard_size)
+                       for part in self.partitions} if shard_size else None
+
         # running indicies for new imgs and annos
         self.img_idx = 0
         self.anno_idx = 0
+        # `ConversionManifest` of the running `convert_all`
+        self.manifest = None
 
-        # info for output annotation json
-        self.new_img_names = []
-        self.new_img_ids = []
-        self.new_box_annos = []
-        self.new_areas = []
-        self.new_prompts = []
-        self.new_anno_ids = []
-        self.new_cats = []
+        # annotation entries for the output json, streamed to disk
+        self.entries = AnnotationWriter(self.dst/(Path(self.new_annos).stem + '.entries.jsonl'),
+                                        multi_prompt = multi_prompt)
 
     def __len__(self):
         return len(self.full_img_ids)
@@ -327,7 +1525,7 @@ class ConversionDataset():
         img_ids = list(sorted(coco.imgs.keys()))
         return coco, img_ids
 
-    def load_img(self, img_id):
+    def load_img(self, img_id, img = None, rng = None):
         """
         Load image, boxes, box centers, and category ids
 
@@ -335,14 +1533,30 @@ class ConversionDataset():
 
         img_id : id of an image in the annotation file
 
+        img : optional, the already decoded image, see `read_img`
+
+        rng : optional np.random.Generator for the prompt noise, see `img_rng`
+
         **Returns**
 
-        img : Pillow image
+        img : uint8 np.ndarray image [H, W, 3]
 
         bboxs : list of box coordinates [[xmin, ymin, ]]
 
         cntrs : list of box (object) prompts
+
+        cats : list of (category name, category id) of the boxes
         """
+        # open image
+        if img is None:
+            img = self.read_img(img_id)
+
+        bboxs, prompts, cats = self.load_objs(img_id, rng)
+        return img, bboxs, prompts, cats
+
+
+    def load_objs(self, img_id, rng = None):
+        """Load boxes, prompts and category ids of an image without decoding it, see `load_img`"""
 
         # list of annotation ids
         ann_ids = self.coco.getAnnIds(imgIds = img_id)
@@ -350,11 +1564,6 @@ class ConversionDataset():
         coco_annos = self.coco.loadAnns(ann_ids)
         coco_annos = [anno for anno in coco_annos if anno['iscrowd'] == 0]
         num_objs = len(coco_annos)
-        # path for image
-        img_path = self.coco.loadImgs(img_id)[0]['file_name']
-        # open image
-        img = Image.open(os.path.join(self.data, img_path))
-        if img.mode == 'L': img = img.convert('RGB')
 
         # Bounding box format: [xmin, ymin, width, height]
         bboxs = []
@@ -387,17 +1596,32 @@ class ConversionDataset():
 
             cat = self.coco.loadCats(coco_annos[i]['category_id'])
 
-            cats.append(cat[0]['name'])
+            cats.append((cat[0]['name'], coco_annos[i]['category_id']))
 
-        prompts = utils.get_prompt_points(coco_annos, self.n, self.prompt_format)
+        prompts = utils.get_prompt_points(coco_annos, self.n, self.prompt_format, rng = rng)
 
         assert len(prompts) == len(bboxs), 'Prompt and box length are not the same'
 
 #         if sum(num_pos) != len(prompts):
 #             print(f'Not same length!!: {sum(num_pos)}  !=  {len(prompts)}')
 
-        return img, bboxs, prompts, cats #cntrs,
+        return bboxs, prompts, cats #cntrs,
+
+
+    def read_img(self, img_id):
+        """Decode the source image of `img_id` as uint8 np.ndarray"""
+        img_path = self.coco.loadImgs(img_id)[0]['file_name']
+        return utils.decode_image(os.path.join(self.data, img_path), backend = self.decode_backend)
+
+    def read_bytes(self, img_id):
+        """Encoded source image file of `img_id`"""
+        img_path = self.coco.loadImgs(img_id)[0]['file_name']
+        with open(os.path.join(self.data, img_path), 'rb') as f:
+            return f.read()
 
+    def read_src(self, img_id):
+        """Source of `img_id` for `crop_arrays`, the encoded file with `roi_decode`, else the decoded image"""
+        return self.read_bytes(img_id) if self.roi_decode else self.read_img(img_id)
 
     def noise(self, val, size, pct = 0.2):
         """
@@ -424,13 +1648,14 @@ class ConversionDataset():
 
 
     def crop_objs(self, img, bboxs, prompts, cats, inp_crop_size = 100,
-        crop_noise = 0.1, resize = True, img_size = 512, box_noise = 0.05):
+        crop_noise = 0.1, resize = True, img_size = 512, box_noise = 0.05, multi_prompt = False,
+        rng = None):
         """
         Crop individual square images for each object (box) in img
 
         **Params**
 
-        img : image to take crops from
+        img : image to take crops from, uint8 np.ndarray or Pillow image
 
         bboxs : box coordinates [[xmin,ymin,xmax,ymax]]
 
@@ -444,275 +1669,289 @@ class ConversionDataset():
 
         box_noise : percent of noise to add to box off set
 
+        multi_prompt : take one crop per object with all of its prompt points instead of one crop per point
+
+        rng : optional np.random.Generator for the crop noise, the global numpy RNG if None
+
         **Return**
 
         imgs_crop : list of cropped np.array images
 
         boxs_crop : list of cropped bbox corrdinates
 
-        prompts_crop : list of cropped object prompt coordinates
+        prompts_crop : list of cropped object prompt coordinates, lists of them with `multi_prompt`
 
         """
         # pillow coorodinates (x,y):
         #   - start  : upper left corner (0,0)
         #   - finish : bottom right corner (w,h)
 
-        w, h = img.size
-        assert (inp_crop_size < w and inp_crop_size < h), \
-            'crop size is larger than image'
+        # crops are views into the one decoded array
+        img = np.asarray(img)
+        h, w = img.shape[:2]
+        plan = self.plan_crops(bboxs, prompts, w, h, inp_crop_size = inp_crop_size, crop_noise = crop_noise,
+                               box_noise = box_noise, multi_prompt = multi_prompt, rng = rng)
+        return self.cut_crops(plan, [(img, 0, 0)]*len(plan['crops']), cats, resize = resize,
+                              img_size = img_size, multi_prompt = multi_prompt)
 
-        imgs_crop, boxs_crop, prompts_crop, cats_crop = [], [], [], []
+    def plan_crops(self, bboxs, prompts, img_w, img_h, inp_crop_size = 100, crop_noise = 0.1,
+                   box_noise = 0.05, multi_prompt = False, rng = None):
+        """
+        Draw the crop windows of `crop_objs` from the boxes and image size alone, before any decoding
 
-        num_pos = []
-        wrong = 0
+        **Returns**
 
-        # loop over boxes and prompt sets
-        for box, prompt, cat in zip(bboxs, prompts, cats):
+        plan dict with the crop `windows`, the box and prompt cords relative to them, and the
+        indices of the windows that give a crop ('crops')
+        """
+        assert (inp_crop_size < img_w and inp_crop_size < img_h), \
+            'crop size is larger than image'
 
+        # flat prompt points (could be more than one per object) and their objects
+        bboxs = np.asarray(bboxs, dtype = np.float64).reshape(-1, 4)
+        pts = np.array([pt for prompt in prompts for pt in prompt], dtype = np.float64).reshape(-1, 2)
+        pt_obj = np.repeat(np.arange(len(bboxs)), [len(prompt) for prompt in prompts])
 
-            xmin, ymin, xmax, ymax = box
-            boxw, boxh = xmax - xmin, ymax - ymin
-            box_cntr = (xmin + (boxw/2), ymin + (boxh/2))
+        # one crop per prompt point, or one crop per object holding all of its prompt points
+        crop_obj = np.arange(len(bboxs)) if multi_prompt else pt_obj
+        pt_crop = pt_obj if multi_prompt else np.arange(len(pts))
 
-            # debug
-            if xmin >= 0 and ymin >= 0 and xmax >= 0 and ymax >= 0:
-                num_pos.append(True)
-            else:
-                num_pos.append(False)
-
-
-            # loop over points in prompt (could be more than one per object)
-            for point in prompt:
-
-#                 print(f'Box cords before transform: {xmin} {ymin} {xmax} {ymax}')
-#                 print(f'Prompt point: {point}')
-
-#                 if (point[0] > xmax) or (point[0] < xmin):
-#                     print(f'X prompt {point[0]} box x bounds: {xmin}, {xmax}')
-#                 if (point[1] > ymax) or (point[1] < ymin):
-#                     print(f'Y prompt {point[1]} box y bounds: {ymin}, {ymax}')
-
-                # add noise to corp size for each prompt point
-                crop_size = self.noise(val = inp_crop_size,
-                                       size = inp_crop_size, pct = crop_noise)
-
-                # adjust crop size if necessary
-                # crop too small, box taking up more than 90% of crop in either dimension
-                too_small = (boxw >= (crop_size * 0.9)) or (boxh >= (crop_size * 0.9))
-#                 while too_big is True:
-                if too_small:
-#                     print(too_small)
-#                     print(f'Box w: {boxw}  Box h: {boxh}')
-#                     print(f'Original crop size: {crop_size}')
-                    crop_size = max(boxw, boxh)*(random.uniform(1.2, 1.4))
-#                     print(f'Updated crop size : {crop_size}')
-#                     too_big = (boxw > crop_size * 0.9) or (boxh > crop_size * 0.9)
-                # clip crop size to shortest img dimension
-                if crop_size > min(w, h):
-#                     print('Crop too big')
-                    crop_size = min(w, h)
-
-                if crop_size < max(boxw, boxh):
-                    continue
+        # noisy square crop windows around the boxes for all crops at once
+        windows = utils.crop_windows(bboxs[crop_obj], img_w, img_h, crop_size = inp_crop_size,
+                                     crop_noise = crop_noise, box_noise = box_noise, rng = rng)
+        ofsts = np.stack([windows['left'], windows['upper']], axis = 1)
 
-#                 print(f'Img w: {w}  Img h: {h}')
-#                 print(f'Crop size: {crop_size}')
-#                 print(f'Box width: {boxw}  Box height: {boxh}')
-
-#                 if (boxw > crop_size * 0.9) or (boxh > crop_size * 0.9):
-#                     # make crop-size larger
-#                     crop_size = max(boxw, boxh)/(random.uniform(0.4, 0.8))
-
-                orig_size = crop_size
-#                 print(crop_size)
-                # copy image for crop
-                cimg = img.copy()
-
-                # starting corp cords
-                left = box_cntr[0] - (crop_size / 2)
-                upper = box_cntr[1] - (crop_size / 2)
-
-#                 print(f'Before noise left: {left}  upper: {upper}')
-
-
-                # max difference the starting crop values (left, upper) can be adjusted before
-                # interfering with the object box bounds
-                max_wd = (xmin - left) - 1
-                max_hd = (ymin - upper) - 1
-                old_left = left
-                old_upper = upper
-
-                # add noise so box isn't always exactly in the center of crop
-                left = self.noise(val = left, size = crop_size, pct = box_noise)
-                upper = self.noise(val = upper, size = crop_size, pct = box_noise)
-
-#                 print(f'After noise left: {left}  upper: {upper}')
-
-                # check if noise:
-                # - pushed crop bounds into box bounds
-#                 if left > xmin: left = xmin - 1
-#                 if upper > ymin: upper = ymin - 1
-                # - pushed crop bounds too far relative to box bounds
-                if abs(left - old_left) > max_wd:
-                    if left > old_left:
-                        left = old_left + max_wd
-                    if left < old_left:
-                        left = old_left - max_wd
-
-                if abs(upper - old_upper) > max_hd:
-                    if upper > old_upper:
-                        upper = old_upper + max_hd
-                    if upper < old_upper:
-                        upper = old_upper - max_hd
-
-
-
-                right, lower = left + crop_size, upper + crop_size
-
-                # check and correct for out of bounds crop
-                if left < 0:
-                    left = 0
-                    right = left + crop_size
-                if upper < 0:
-                    upper = 0
-                    lower = upper + crop_size
-                if right > w:
-                    right = w
-                    left = right - crop_size
-                if lower > h:
-                    lower = h
-                    upper = lower - crop_size
-
-                # compute new box coordinates: [xmin, ymin, xmax, ymax]
-                xmin_crop = (xmin - left)
-#                 if xmin_crop < 0:
-#                     print('-'*10)
-#                     print(left)
-                ymin_crop = (ymin - upper)
-                xmax_crop = (xmax - left)
-                ymax_crop = (ymax - upper)
-                bbox = [xmin_crop, ymin_crop, xmax_crop, ymax_crop]
-
-                # compute relative prompt cords based on image crop
-                x_prompt_rel = point[0] - left
-                y_prompt_rel = point[1] - upper
-
-
-                # debug
-#                 print(f'Relative box cords: {xmin_crop} {ymin_crop} {xmax_crop} {ymax_crop}')
-#                 print(f'Relative prompt point: {x_prompt_rel}  {y_prompt_rel}')
-
-
-
-                # check for out of bounds
-                if ((x_prompt_rel > crop_size) or (y_prompt_rel > crop_size)):
-                    print('-'*100)
-                    print(f'X rel: {x_prompt_rel}  Y rel: {y_prompt_rel}  Crop size: {crop_size}')
-                    continue
+        # box [xmin, ymin, xmax, ymax] and prompt cords relative to the crops
+        boxs_rel = bboxs[crop_obj] - np.tile(ofsts, 2)
+        pts_rel = pts - ofsts[pt_crop]
+        # drop prompts outside of their crop
+        pts_ok = (pts_rel <= windows['crop_size'][pt_crop, None]).all(axis = 1)
 
-                # crop expects 4-tupple: (left, upper, right, lower)
-                img_crop = img.crop((left, upper, right, lower))
+        # prompt points of crop i are pts_rel[starts[i]:stops[i]]
+        starts = np.searchsorted(pt_crop, np.arange(len(windows)), side = 'left')
+        stops = np.searchsorted(pt_crop, np.arange(len(windows)), side = 'right')
 
-                if resize:
-                    img_resz, box_resz = utils.resize(img_size,
-                        np.array(img_crop), np.array([bbox]))
+        # windows that fit their box and keep at least one prompt
+        crops = [i for i in np.flatnonzero(windows['valid']) if pts_ok[starts[i]:stops[i]].any()]
 
-                    # reszd box cords
-                    xmi_resz, ymi_resz, xma_resz, yma_resz = box_resz[0]
-                    # clip box cords to image dims
-                    if xmi_resz < 0: xmi_resz = 0
-                    if ymi_resz < 0: ymi_resz = 0
-                    if xma_resz > img_resz.shape[1]: xma_resz = img_resz.shape[1]
-                    if yma_resz > img_resz.shape[0]: yma_resz = img_resz.shape[0]
-                    box_resz = [xmi_resz, ymi_resz, xma_resz, yma_resz]
+        return {'windows': windows, 'crop_obj': crop_obj, 'boxs_rel': boxs_rel, 'pts_rel': pts_rel,
+                'pts_ok': pts_ok, 'starts': starts, 'stops': stops, 'crops': crops}
 
-                    # compute resized prompt coordinates based on image resize
-                    new_size = img_resz.shape[:2]
+    def cut_crops(self, plan, regions, cats, scale = 1, resize = True, img_size = 512,
+                  multi_prompt = False):
+        """
+        Cut the planned crops out of the decoded image
 
-                    x_scale = new_size[1] / orig_size
-                    y_scale = new_size[0] / orig_size
+        **Params**
 
-                    x_prompt_rel_resize = x_prompt_rel * x_scale
-                    y_prompt_rel_resize = y_prompt_rel * y_scale
+        plan : crop plan from `plan_crops`
 
+        regions : decoded (img, left, upper) holding each crop of the plan, at 1/`scale` resolution
+            with the full resolution cords of their upper left corner, see `utils.decode_regions`
 
-                    # debug
-#                     print(f'Resized box cords: {xmi_resz} {ymi_resz} {xma_resz} {yma_resz}')
-#                     print(f'Resized prompt point: {x_prompt_rel_resize}  {y_prompt_rel_resize}')
+        cats : categories of the boxes
 
+        scale : downscale factor the regions were decoded at, crops must be resized if > 1
 
-#                     check for out of bounds:
-                    if ((x_prompt_rel_resize > img_size) or (y_prompt_rel_resize > img_size)):
-                        print(f'X rel resize: {x_prompt_rel_resize}  Y rel resize: {y_prompt_rel_resize}  Img size: {img_size}')
-#                         wrong += 1
+        **Return**
 
-                    prompt_resz = (x_prompt_rel_resize, y_prompt_rel_resize)
+        imgs_crop, boxs_crop, prompts_crop, cats_crop like `crop_objs`
+        """
+        assert resize or scale == 1, 'Reduced-scale decoding needs resized crops'
+        windows, boxs_rel, pts_rel, pts_ok = plan['windows'], plan['boxs_rel'], plan['pts_rel'], plan['pts_ok']
+        starts, stops = plan['starts'], plan['stops']
 
-                    imgs_crop.append(img_resz)
-                    boxs_crop.append(box_resz)
-                    prompts_crop.append(prompt_resz)
+        imgs_crop, boxs_crop, prompts_crop, cats_crop = [], [], [], []
 
-                # no resize
+        for i, (src, ofst_x, ofst_y) in zip(plan['crops'], regions):
+            points_rel = pts_rel[starts[i]:stops[i]][pts_ok[starts[i]:stops[i]]]
+            points_rel = [tuple(pt) for pt in points_rel.tolist()]
+            left, upper, right, lower, orig_size = (float(windows[i][field]) for field in
+                ['left', 'upper', 'right', 'lower', 'crop_size'])
+            bbox = boxs_rel[i].tolist()
+
+            if scale == 1:
+                # crop expects 4-tupple: (left, upper, right, lower), rounded on the full image and
+                # relative to the decoded region
+                img_crop = utils.crop_view(src, (round(left) - ofst_x, round(upper) - ofst_y,
+                                                 round(right) - ofst_x, round(lower) - ofst_y))
+
+            if resize:
+                if scale == 1:
+                    img_resz, box_resz = utils.resize(img_size,
+                        img_crop, np.array([bbox]))
+                # resample the reduced-scale region on the pixel grid of the full resolution crop
                 else:
-                    imgs_crop.append(np.array(img_crop))
-                    boxs_crop.append([bbox])
-                    prompts_crop.append((x_prompt_rel, y_prompt_rel))
+                    img_resz, box_resz = utils.resize_region(img_size, src, (left, upper, right, lower),
+                        np.array([bbox]), ofst_x, ofst_y, scale)
+
+                # reszd box cords
+                xmi_resz, ymi_resz, xma_resz, yma_resz = box_resz[0]
+                # clip box cords to image dims
+                if xmi_resz < 0: xmi_resz = 0
+                if ymi_resz < 0: ymi_resz = 0
+                if xma_resz > img_resz.shape[1]: xma_resz = img_resz.shape[1]
+                if yma_resz > img_resz.shape[0]: yma_resz = img_resz.shape[0]
+                box_resz = [xmi_resz, ymi_resz, xma_resz, yma_resz]
+
+                # compute resized prompt coordinates based on image resize
+                new_size = img_resz.shape[:2]
 
-                cats_crop.append(cat)
+                x_scale = new_size[1] / orig_size
+                y_scale = new_size[0] / orig_size
 
-#         if sum(num_pos) != (len(prompts_crop)/self.n):
-#         print(f'Num wrong: {wrong}')
+                prompts_resz = [(x_prompt_rel * x_scale, y_prompt_rel * y_scale)
+                                for x_prompt_rel, y_prompt_rel in points_rel]
+
+                imgs_crop.append(img_resz)
+                boxs_crop.append(box_resz)
+                prompts_crop.append(prompts_resz if multi_prompt else prompts_resz[0])
+
+            # no resize
+            else:
+                # clip box cords to image dims
+                crph, crpw = img_crop.shape[:2]
+                bbox = [max(bbox[0], 0), max(bbox[1], 0),
+                        min(bbox[2], crpw), min(bbox[3], crph)]
+                imgs_crop.append(img_crop)
+                boxs_crop.append(bbox)
+                prompts_crop.append(points_rel if multi_prompt else points_rel[0])
+
+            cats_crop.append(cats[plan['crop_obj'][i]])
 
         return imgs_crop, boxs_crop, prompts_crop, cats_crop
 
 
 
-    def convert(self, img_id, cord_format = None):
+    def crop_img(self, img_id, cord_format = None, rng = None):
         """
-        Convert a single image in the dataset into multipls
-        point-to-box style images
+        Crop, resize and encode all objects of a single image
+
+        Does not touch the running ids or the new annotation lists, so it can run in a
+        worker process, see `add_crops`.
 
         **Params**
 
         img_id : id of the image in the coco-style annotation file
 
-        coord_format : optional format for bbox conversion, if None then no conversion is applied
+        coord_format : optional format for bbox conversion, see `convert`
 
-        - cnt_ofst         : [xofst, yofst, w, h]
-        - cntr_ofst_frac   : [xofst, yofst, w, h] as fraction of image width/height
-        - corner_ofst_frac : [xmin, ymin, w, h] as fraction of image width/height
+        rng : optional np.random.Generator for the prompt and crop noise, see `img_rng`
+
+        **Returns**
+
+        list of crop dicts with the encoded image ('data') and its annotation info
+        """
+        crops = self.crop_arrays(img_id, cord_format, rng = rng)
+        for crop in crops:
+            crop['data'] = self.encode(crop.pop('img'))
+        return crops
 
+    def decode_plan(self, plan, img_w, img_h):
         """
-        # load full img and annos
-        img, bboxs, prompts, cats = self.load_img(img_id)
+        Downscale factor and regions to decode for a crop plan, see `roi_decode`
 
-        # crop objs
-        crop_imgs, crop_bboxs, crop_prompts, crop_cats = self.crop_objs(
-            img = img,
-            bboxs = np.array(bboxs),
-            prompts = prompts,
-            cats = cats,
-            inp_crop_size = self.crop_size,
-            crop_noise = self.crop_noise,
-            box_noise = self.box_noise,
-            img_size = self.img_size
-        )
+        **Returns**
+
+        scale : largest factor up to `max_decode_scale` that keeps every crop at least `img_size`
+            pixels across, so crops are never upsampled, 1 without resizing
+
+        boxes : regions (left, upper, right, lower) to decode, the unions of overlapping and nearby
+            crop windows, None to decode the whole image
+
+        owners : index of the region in `boxes` holding each crop of the plan, None with `boxes`
+        """
+        windows = plan['windows'][plan['crops']]
+        scale = 1
+        if self.resize and not self.native and len(windows):
+            min_crop = windows['crop_size'].min()
+            scale = max((s for s in [2, 4, 8] if s <= self.max_decode_scale and min_crop >= s*self.img_size),
+                        default = 1)
+
+        # overlapping windows and windows less than the largest MCU apart are decoded once
+        boxes, owners = utils.merge_regions([tuple(float(window[field]) for field in
+                                                   ['left', 'upper', 'right', 'lower']) for window in windows],
+                                            gap = 32)
+        clipped = np.clip(np.array(boxes).reshape(-1, 4), 0, [img_w, img_h, img_w, img_h])
+        area = ((clipped[:, 2] - clipped[:, 0]) * (clipped[:, 3] - clipped[:, 1])).sum()
+        if len(boxes) > self.roi_max_regions or area >= self.roi_frac * img_w * img_h:
+            return scale, None, None
+        return scale, boxes, owners
+
+    def planned_crops(self, img_id, data = None, rng = None):
+        """
+        `crop_objs` that plans the crops from the image header and decodes only what they need, see `roi_decode`
+
+        **Params**
+
+        img_id : id of the image in the coco-style annotation file
+
+        data : optional, encoded source image file, see `read_src`
+
+        rng : optional np.random.Generator for the prompt and crop noise, see `img_rng`
+        """
+        if data is None:
+            data = self.read_bytes(img_id)
+        bboxs, prompts, cats = self.load_objs(img_id, rng)
+        img_w, img_h = utils.image_size(data)
+        plan = self.plan_crops(np.array(bboxs), prompts, img_w, img_h, inp_crop_size = self.crop_size,
+                               crop_noise = self.crop_noise, box_noise = self.box_noise,
+                               multi_prompt = self.multi_prompt, rng = rng)
+        if not plan['crops']:
+            return [], [], [], []
+
+        scale, boxes, owners = self.decode_plan(plan, img_w, img_h)
+        if scale == 1 and boxes is None:
+            regions = [(utils.decode_image(data, backend = self.decode_backend), 0, 0)]
+        else:
+            regions, scale = utils.decode_regions(data, boxes, scale, backend = self.decode_backend)
+        if boxes is None:
+            regions = regions * len(plan['crops'])
+        else:
+            regions = [regions[owner] for owner in owners]
+
+        return self.cut_crops(plan, regions, cats, scale = scale, resize = self.resize and not self.native,
+                              img_size = self.img_size, multi_prompt = self.multi_prompt)
+
+    def encode(self, img):
+        """Encode a uint8 np.ndarray crop with the output `img_format` and `quality`"""
+        buf = io.BytesIO()
+        params = {} if self.quality is None else {'quality': self.quality}
+        Image.fromarray(img).save(buf, format = self.img_format, **params)
+        return buf.getvalue()
+
+    def crop_arrays(self, img_id, cord_format = None, img = None, rng = None):
+        """`crop_img` without the encoding, crop dicts hold the uint8 crop ('img'), `img` is the optional source, see `read_src`"""
+        assert not (self.native and cord_format), \
+            'Native crops are letterboxed at load time, convert boxes there with box_format'
+        if self.roi_decode:
+            crop_imgs, crop_bboxs, crop_prompts, crop_cats = self.planned_crops(img_id, img, rng)
+
+        else:
+            # load full img and annos
+            img, bboxs, prompts, cats = self.load_img(img_id, img, rng)
+
+            # crop objs
+            crop_imgs, crop_bboxs, crop_prompts, crop_cats = self.crop_objs(
+                img = img,
+                bboxs = np.array(bboxs),
+                prompts = prompts,
+                cats = cats,
+                inp_crop_size = self.crop_size,
+                crop_noise = self.crop_noise,
+                box_noise = self.box_noise,
+                resize = self.resize and not self.native,
+                img_size = self.img_size,
+                multi_prompt = self.multi_prompt,
+                rng = rng
+            )
 
 #         print(f'Cats: {len(crop_cats)}  Crop prompts: {len(crop_prompts)}')
 
-        # loop over crops and save
-        for new_img, box, prompt, cat in zip(crop_imgs, crop_bboxs,
-                                           crop_prompts, crop_cats):
-            # save img
-            new_img_name = f'img_{self.img_idx}_anno_{self.anno_idx}_{cat}_.jpg'
-            new_img_pth = self.dst/new_img_name
-            img = Image.fromarray(new_img)
-            img.save(new_img_pth)
-
-            # construct and append annotation info to lists
-#             print(f'npbox: {npbox}')
-#             box = npbox[0]
-#             print(f'box: {box}')
+        crops = []
+        for new_img, box, prompt, (cat, cat_id) in zip(crop_imgs, crop_bboxs,
+                                                       crop_prompts, crop_cats):
+            # construct annotation info
             w, h = box[2] - box[0], box[3] - box[1]
             area = w * h
             if cord_format:
@@ -724,42 +1963,442 @@ class ConversionDataset():
             else:
                 coco_box = [box[0], box[1], w, h]
 
-            self.new_img_names.append(new_img_name)
-            self.new_img_ids.append(self.img_idx)
-            self.new_box_annos.append(coco_box)
-            self.new_areas.append(area)
-            self.new_prompts.append(prompt)
-            self.new_anno_ids.append(self.anno_idx)
-            self.new_cats.append(cat)
+            # letterbox parameters of the native crop for the training size
+            letterbox = None
+            if self.native:
+                scale, pad_x, pad_y = utils.letterbox_params(new_img.shape[1], new_img.shape[0],
+                                                             self.img_size)
+                letterbox = {'size': self.img_size, 'scale': scale, 'pad': [pad_x, pad_y]}
+
+            # all prompt points of the object, the first one is its 'prompt'
+            prompt_pts = [[float(c) for c in pt] for pt in (prompt if self.multi_prompt else [prompt])]
+
+            crops.append({'img': new_img, 'dims': (new_img.shape[1], new_img.shape[0]),
+                          'bbox': coco_box, 'area': area, 'cat': cat, 'cat_id': cat_id,
+                          'letterbox': letterbox,
+                          'prompt': prompt_pts if self.multi_prompt else prompt,
+                          'prompts': prompt_pts})
+        return crops
+
+
+    def add_crops(self, crops, src_id = None):
+        """
+        Assign image and annotation ids to crops from `crop_img`, save them and record their annotations
+
+        **Params**
+
+        crops : list of crop dicts from `crop_img`
+
+        src_id : optional id of the source image, logged to the running manifest
+        """
+        entries, shards = [], set()
+        for crop in crops:
+            key = f'img_{self.img_idx}_anno_{self.anno_idx}_{crop["cat"]}_'
+            new_img_name = key + self.img_ext
+            w, h = crop['dims']
+            split_key = self.split_key(src_id, self.img_idx)
+            part = self.partition(split_key) if self.val_pct > 0 else ''
+            entry = {'img_names': os.path.join(part, self.node_dir, new_img_name), 'img_ids': self.img_idx,
+                     'img_dims': [w, h], 'letterboxes': crop['letterbox'],
+                     'box_annos': [float(c) for c in crop['bbox']], 'areas': float(crop['area']),
+                     'prompts': crop['prompt'], 'anno_ids': self.anno_idx, 'cats': crop['cat'],
+                     'cat_ids': crop['cat_id'], 'src_ids': src_id, 'partition': part, 'split_key': split_key}
+            # save img, straight into its partition, under a temporary name until it is logged
+            if self.shards is None:
+                with open(self.dst/(entry['img_names'] + '.tmp'), 'wb') as f:
+                    f.write(crop['data'])
+            else:
+                image, annotation = self.entries.coco_records(entry)
+                image['file_name'] = new_img_name
+                shard = self.shards[part].write(key, crop['data'], {'image': image, 'annotation': annotation},
+                                                ext = self.img_ext[1:])
+                shard = os.path.join(part, self.node_dir, shard)
+                shards.add(shard)
+                # file name inside the shard
+                entry['img_names'] = f'{shard}/{new_img_name}'
+
+            self.entries.write(entry)
+            entries.append(entry)
 
             self.img_idx += 1
             self.anno_idx += 1
 
+        if self.manifest is not None and src_id is not None:
+            self.manifest.add(src_id, self.src_signature(src_id), entries, shards)
+            self.manifest.flush(self.done_shards())
+        # a crash before this point leaves only temporary files, see `open_manifest`
+        if self.shards is None:
+            for entry in entries:
+                self.finish_crop(entry)
+
+    def finish_crop(self, entry):
+        """Give the crop file of a logged entry its final name"""
+        tmp = self.dst/(entry['img_names'] + '.tmp')
+        if tmp.exists():
+            os.replace(tmp, self.dst/entry['img_names'])
+
+    def done_shards(self):
+        """Finished tar shards of all partitions, relative to `dst`"""
+        if self.shards is None:
+            return []
+        return [os.path.join(part, self.node_dir, shard) for part, writer in self.shards.items()
+                for shard in writer.shards]
+
+    @staticmethod
+    def split_hash(key, seed = 0):
+        """Deterministic hash of `key` and `seed` as a float in [0, 1)"""
+        return int(hashlib.sha1(f'{seed}:{key}'.encode()).hexdigest()[:15], 16) / 16**15
+
+    def partition(self, key, pct = None):
+        """
+        Partition of a crop, 'val' for a `pct` (default `val_pct`) fraction of the hash keys, else 'train'
+
+        The key is the source image id (`split_by` 'src') or the output image id (`split_by` 'crop'),
+        see `split_key`, so the split does not depend on the conversion order or on resuming.
+        """
+        pct = self.val_pct if pct is None else pct
+        return 'val' if self.split_hash(key, self.split_seed) < pct else 'train'
+
+    def split_key(self, src_id, img_id):
+        """Partition hash key of a crop, see `split_by`, output image ids are only unique per node"""
+        if self.split_by == 'src' and src_id is not None:
+            return src_id
+        return img_id if self.num_nodes == 1 else f'{self.node_index}:{img_id}'
+
+    def entry_key(self, entry):
+        """Partition hash key of an annotation entry, stored with it as its ids change in `merge_nodes`"""
+        if 'split_key' in entry:
+            return entry['split_key']
+        return self.split_key(entry['src_ids'], entry['img_ids'])
+
+
+    def convert(self, img_id, cord_format = None):
+        """
+        Convert a single image in the dataset into multipls
+        point-to-box style images
+
+        **Params**
+
+        img_id : id of the image in the coco-style annotation file
+
+        coord_format : optional format for bbox conversion, if None then no conversion is applied
+
+        - cnt_ofst         : [xofst, yofst, w, h]
+        - cntr_ofst_frac   : [xofst, yofst, w, h] as fraction of image width/height
+        - corner_ofst_frac : [xmin, ymin, w, h] as fraction of image width/height
+
+        """
+        self.make_dirs()
+        self.add_crops(self.crop_img(img_id, cord_format), img_id)
+
+    def make_dirs(self):
+        """Create the partition directories of this node, only converting writes to `dst`"""
+        for part in self.partitions:
+            (self.dst/part/self.node_dir).mkdir(parents = True, exist_ok = True)
+
+    @staticmethod
+    def img_rng(seed, img_id):
+        """Own np.random.Generator for the crop and prompt noise of one image, None (global RNGs) if `seed` is None"""
+        return None if seed is None else np.random.default_rng([seed, img_id])
+
+    def seeded_crop_img(self, img_id, cord_format = None, seed = None):
+        """`crop_img` with the noise drawn from the (`seed`, `img_id`) generator, see `img_rng`"""
+        return self.crop_img(img_id, cord_format, rng = self.img_rng(seed, img_id))
+
+    @staticmethod
+    def _put(q, item, stop):
+        """Put `item` on queue `q` unless `stop` is set, returns the seconds spent blocked"""
+        start = time.time()
+        while not stop.is_set():
+            try:
+                q.put(item, timeout = 0.1)
+                break
+            except queue.Full: pass
+        return time.time() - start
+
+    @staticmethod
+    def _get(q, stop, default):
+        """Get an item from queue `q`, `default` if `stop` is set first, and the seconds spent blocked"""
+        start = time.time()
+        while not stop.is_set():
+            try:
+                return q.get(timeout = 0.1), time.time() - start
+            except queue.Empty: pass
+        return default, time.time() - start
+
+    def convert_staged(self, img_ids, cord_format = None, seed = None, read_ahead = 4,
+                       crop_ahead = 4, encode_threads = 4):
+        """
+        Convert images in a pipeline of overlapping stages connected by bounded queues
+
+        A reader thread prefetches decoded source images (encoded ones with `roi_decode`, the
+        crop thread decodes them), a crop thread crops and resizes them and hands the crops
+        to a pool of encoder threads, and the calling thread saves the encoded crops in image
+        id order. The seconds each stage was stalled, waiting for input or for room in its
+        output queue, are stored in `stalls`.
 
-    def convert_all(self, pct = 1.0, cord_format = None):
+        **Params**
+
+        img_ids : ids of the images to convert
+
+        cord_format : optional format for bbox conversion, see `convert`
+
+        seed : optional base seed for the per-image RNGs, see `convert_all`
+
+        read_ahead : max number of decoded source images waiting to be cropped
+
+        crop_ahead : max number of cropped images waiting to be encoded and saved
+
+        encode_threads : number of encoder threads
+        """
+        self.make_dirs()
+        stop = threading.Event()
+        done = object()
+        read_q = queue.Queue(maxsize = read_ahead)
+        crop_q = queue.Queue(maxsize = crop_ahead)
+        self.stalls = {'read': 0., 'crop': 0., 'write': 0.}
+
+        def read():
+            try:
+                for img_id in img_ids:
+                    if stop.is_set(): return
+                    item = (img_id, self.read_src(img_id))
+                    self.stalls['read'] += self._put(read_q, item, stop)
+            except Exception as e:
+                self._put(read_q, e, stop)
+                return
+            self._put(read_q, done, stop)
+
+        def crop(pool):
+            try:
+                while True:
+                    item, wait = self._get(read_q, stop, done)
+                    self.stalls['crop'] += wait
+                    if item is done or isinstance(item, Exception):
+                        self._put(crop_q, item, stop)
+                        return
+                    img_id, img = item
+                    crops = self.crop_arrays(img_id, cord_format, img, rng = self.img_rng(seed, img_id))
+                    futures = [pool.submit(self.encode, crop.pop('img')) for crop in crops]
+                    self.stalls['crop'] += self._put(crop_q, (img_id, crops, futures), stop)
+            except Exception as e:
+                self._put(crop_q, e, stop)
+
+        with ThreadPoolExecutor(max(encode_threads, 1)) as pool:
+            threads = [threading.Thread(target = read, daemon = True),
+                       threading.Thread(target = crop, args = (pool,), daemon = True)]
+            for thread in threads: thread.start()
+            try:
+                for _ in tqdm(img_ids):
+                    start = time.time()
+                    item = crop_q.get()
+                    if item is done: break
+                    if isinstance(item, Exception): raise item
+                    img_id, crops, futures = item
+                    for crop_dict, future in zip(crops, futures):
+                        crop_dict['data'] = future.result()
+                    self.stalls['write'] += time.time() - start
+                    self.add_crops(crops, img_id)
+            finally:
+                # stop the other stages if saving exits early
+                stop.set()
+                for thread in threads: thread.join()
+
+
+    def convert_all(self, pct = 1.0, cord_format = None, workers = 0, seed = None,
+                    mp_context = None, chunksize = 4, read_ahead = 4, crop_ahead = 4,
+                    encode_threads = 4, resume = False, prefetch = 2):
         """
         Convert all (or a percentage) of photos and annotations in the dataset
 
+        Images are cropped and encoded on a process pool with `workers` > 0, otherwise in
+        the overlapping stages of `convert_staged`. Crops are added in image id order, and
+        every image draws its noise from its own (`seed`, img_id) generator, so the output
+        does not depend on the number of workers and the caller's RNGs are left untouched.
+        At most `prefetch` chunks per worker are in flight, so encoded crops do not pile up
+        while they are saved.
+
+        Finished source images are logged to a `ConversionManifest` next to the output
+        annotations. With `resume`, a run with the same parameters skips the images logged
+        as done and unchanged, and appends to the existing output. Changed source images are
+        converted again with new ids, their old crop files are removed. Samples in finished
+        tar shards stay in place, read the shards with the output json, see `ShardDataset`.
+
         **Params**
 
         pct : percent of data to write to train partition
+
+        cord_format : optional format for bbox conversion, see `convert`
+
+        workers : number of worker processes, 0 converts in this process
+
+        seed : optional base seed for the per-image generators, drawn from fresh entropy if None
+
+        mp_context : optional multiprocessing start method of the workers, e.g. 'spawn'
+
+        chunksize : number of image ids sent to a worker at once
+
+        read_ahead, crop_ahead, encode_threads : queue depths and encoder threads of `convert_staged`
+
+        resume : optional, continue the run logged in the manifest
+
+        prefetch : max number of chunks per worker submitted ahead of the one being saved
         """
         img_ids = self.full_img_ids
         if pct < 1.0:
             stop = int(len(img_ids)*pct)
             img_ids = img_ids[:stop]
+        # disjoint subset of this node
+        img_ids = img_ids[self.node_index::self.num_nodes]
+        self.make_dirs()
+        img_ids = self.open_manifest(img_ids, cord_format, resume)
+        if seed is None:
+            seed = int(np.random.SeedSequence().generate_state(1)[0])
+
+        if not workers:
+            self.convert_staged(img_ids, cord_format, seed, read_ahead = read_ahead,
+                                crop_ahead = crop_ahead, encode_threads = encode_threads)
+            self.close()
+            return
+
+        chunks = iter([img_ids[i:i + chunksize] for i in range(0, len(img_ids), chunksize)])
+        pending = deque()
+        with ProcessPoolExecutor(workers, mp_context = multiprocessing.get_context(mp_context),
+                                 initializer = _init_conversion_worker, initargs = (self,)) as pool, \
+                tqdm(total = len(img_ids)) as pbar:
+
+            def submit():
+                while len(pending) < prefetch*workers:
+                    chunk = next(chunks, None)
+                    if chunk is None: return
+                    pending.append((chunk, pool.submit(_conversion_worker_crops, chunk, cord_format, seed)))
+
+            submit()
+            # chunks are saved in submission order, which keeps the image id order
+            while pending:
+                chunk, future = pending.popleft()
+                for img_id, crops in zip(chunk, future.result()):
+                    self.add_crops(crops, img_id)
+                pbar.update(len(chunk))
+                submit()
+        self.close()
+
+    def conversion_params(self, cord_format = None):
+        """Parameters that change the conversion output, keyed in the manifest"""
+        return {'crop_size': self.crop_size, 'crop_noise': self.crop_noise,
+                'resize': self.resize, 'img_size': self.img_size, 'box_noise': self.box_noise,
+                'n': self.n, 'prompt_format': self.prompt_format, 'native': self.native,
+                'multi_prompt': self.multi_prompt, 'img_format': self.img_format,
+                'quality': self.quality, 'cord_format': cord_format, 'shard_size': self.shard_size,
+                'val_pct': self.val_pct, 'split_by': self.split_by, 'split_seed': self.split_seed,
+                'node_index': self.node_index, 'num_nodes': self.num_nodes, 'roi_decode': self.roi_decode,
+                'roi_frac': self.roi_frac, 'max_decode_scale': self.max_decode_scale,
+                'roi_max_regions': self.roi_max_regions}
+
+    def src_signature(self, img_id):
+        """Hash of a source image file's size and modification time and of its annotations"""
+        stat = os.stat(os.path.join(self.data, self.coco.loadImgs(img_id)[0]['file_name']))
+        annos = self.coco.loadAnns(self.coco.getAnnIds(imgIds = img_id))
+        key = json.dumps([stat.st_size, stat.st_mtime_ns, annos], sort_keys = True)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def open_manifest(self, img_ids, cord_format = None, resume = False):
+        """
+        Start the manifest of a `convert_all` run, with `resume` reload the finished crops
+
+        The manifest is streamed twice, only the last line number and signature of every
+        source image are held in memory. Crop files of unlogged crops are deleted.
+
+        **Returns**
+
+        the `img_ids` that still need to be converted
+        """
+        self.manifest = ConversionManifest(self.dst/(Path(self.new_annos).stem + '.manifest.jsonl'),
+                                           self.conversion_params(cord_format))
+        self.manifest.open(resume)
+        if not resume:
+            return img_ids
+        if self.shards is not None:
+            for writer in self.shards.values():
+                writer.resume()
+
+        # last line of every source image, ids of dropped crops are not reused
+        last = {}
+        for i, line in enumerate(self.manifest.lines()):
+            last[line['src_id']] = (i, line['src_sig'])
+            self.img_idx = max([self.img_idx] + [crop['img_ids'] + 1 for crop in line['crops']])
+        self.anno_idx = max(self.anno_idx, self.img_idx)
+        changed = {img_id for img_id in img_ids
+                   if img_id in last and last[img_id][1] != self.src_signature(img_id)}
+
+        # the manifest holds the entries of all finished crops
+        self.entries.open()
+        for i, line in enumerate(self.manifest.lines()):
+            if last[line['src_id']][0] != i:
+                continue
+            for crop in line['crops']:
+                # changed source image, drop its old crops
+                if line['src_id'] in changed:
+                    if self.shards is None:
+                        for name in [crop['img_names'], crop['img_names'] + '.tmp']:
+                            if (self.dst/name).exists():
+                                os.remove(self.dst/name)
+                    continue
+                # logged right before a crash, before the file was renamed
+                if self.shards is None:
+                    self.finish_crop(crop)
+                self.entries.write(crop)
+
+        # crops saved after the last logged source image
+        if self.shards is None:
+            for part in self.partitions:
+                for tmp in (self.dst/part/self.node_dir).glob('*.tmp'):
+                    os.remove(tmp)
+        return [img_id for img_id in img_ids if img_id not in last or img_id in changed]
+
+    def __getstate__(self):
+        # worker processes only need the conversion settings and the coco annotations
+        state = self.__dict__.copy()
+        state['shards'] = None
+        state['manifest'] = None
+        state['entries'] = None
+        return state
+
+    def close(self):
+        """Finish the last tar shard, the manifest and the entries file, call after converting with `convert` directly"""
+        if self.shards is not None:
+            for writer in self.shards.values():
+                writer.close()
+        self.entries.close()
+        if self.manifest is not None:
+            self.manifest.flush(self.done_shards())
+            self.manifest.close()
+
+
+    def coco_sections(self, info = None, licenses = None, categories = None):
+        """'info', 'licenses' and 'categories' sections for the output json, those of the source annotations if None"""
+        if info is None:
+            info =  self.coco.dataset['info']
+
+        if licenses is None:
+            licenses = self.coco.dataset['licenses']
 
-        for img_id in tqdm(img_ids):
-            self.convert(img_id, cord_format)
+        if categories is None:
+            categories = self.coco.dataset['categories']
 
+        return info, licenses, categories
 
     def to_json(self, pct = 0.0, info = None, licenses = None, categories = None):
         """
         Convert new annotations into coco-style json.
 
+        The json is streamed from the entries file written during conversion, see `AnnotationWriter`.
+        Data converted with `val_pct` gets one json per partition directory.
+
         **Params**
 
-        pct : percent of data to write to valid partition
+        pct : percent of data to write to valid partition, moves the converted
+            images, prefer `val_pct` to write them to their partition directly
 
         info : 'info' section for COCO-style JSON
 
@@ -768,110 +2407,421 @@ class ConversionDataset():
         categories : 'categories' section for COCO-style JSON
 
         """
-        if info is None:
-            info =  self.coco.dataset['info']
-
-        if licenses is None:
-            licenses = self.coco.dataset['licenses']
+        sections = self.coco_sections(info, licenses, categories)
 
-        if categories is None:
-            categories = self.coco.dataset['categories']
+        if self.val_pct > 0:
+            assert not pct, 'Data was partitioned during conversion, see val_pct'
+            for part in self.partitions:
+                self.entries.write_coco(self.dst/part/(f'{part}_'+ self.new_annos), *sections,
+                                        keep = lambda entry, part = part: entry['partition'] == part,
+                                        root = part)
 
-        images = []
-        annotations = []
-        size = self.img_size if self.resize else self.crop_size
-        for img_id, img_name, anno_id, box, area, prompt, cat in zip(
-            self.new_img_ids, self.new_img_names,
-            self.new_anno_ids, self.new_box_annos,
-            self.new_areas, self.new_prompts, self.new_cats):
-
-            images.append({
-                'license': 0,
-                'file_name': img_name,
-                'width': size,
-                'height': size,
-                'id': img_id})
-
-            annotations.append({
-                'image_id': img_id,
-                'id': anno_id,
-                'bbox': box,
-                'area': area,
-                'prompt': prompt,
-                'category_id': self.coco.getCatIds(catNms = cat)[0],
-                'iscrowd': 0})
-
-
-        json_data = {
-            'info': info,
-            'licenses': licenses,
-            'images': images,
-            'annotations': annotations,
-            'categories': categories}
-
-        if pct > 0.0:
-            self.split(json_data, pct)
+        elif pct > 0.0:
+            assert self.shards is None, 'Splitting moves image files, not supported for shards'
+            self.split(pct, *sections)
 
         else:
-            with open(self.dst/self.new_annos, 'w') as json_file:
-                json.dump(json_data, json_file)
+            self.entries.write_coco(self.dst/self.new_annos, *sections)
 
+    def to_folds(self, k, info = None, licenses = None, categories = None):
+        """
+        Write k-fold cross-validation json files without moving any images
 
-    def split(self, json_data, pct):
-        """Randomly splits and moves data into train/valid partitions
+        Every fold holds out the crops whose `split_hash` falls into its 1/k slice, keyed as in
+        `partition`. Fold i is written to `fold<i>_train_<new annos>` and `fold<i>_val_<new annos>`
+        in `dst`, with image file names relative to `dst`.
 
         **Params**
 
-        json_data : coco-style json dict to split into two
+        k : number of folds
 
-        pct : percent of data to assign to valid split
+        info, licenses, categories : sections of the COCO-style JSON, see `to_json`
         """
+        sections = self.coco_sections(info, licenses, categories)
 
-        idxs = [i for i in range(len(json_data['images']))]
-        random.shuffle(idxs)
-        splt = int(len(idxs)*(1-pct))
+        def fold(entry):
+            return int(self.split_hash(self.entry_key(entry), self.split_seed) * k)
 
-        train_json ={
-            'info' : json_data['info'],
-            'licenses' : json_data['licenses'],
-            'categories' : json_data['categories'],
-            'images' : list(map(json_data['images'].__getitem__, idxs[:splt])),
-            'annotations' : list(map(json_data['annotations'].__getitem__, idxs[:splt])),
-        }
+        for i in range(k):
+            self.entries.write_coco(self.dst/(f'fold{i}_train_'+ self.new_annos), *sections,
+                                    keep = lambda entry, i = i: fold(entry) != i)
+            self.entries.write_coco(self.dst/(f'fold{i}_val_'+ self.new_annos), *sections,
+                                    keep = lambda entry, i = i: fold(entry) == i)
 
-        val_json = {
-            'info' : json_data['info'],
-            'licenses' : json_data['licenses'],
-            'categories' : json_data['categories'],
-            'images' : list(map(json_data['images'].__getitem__, idxs[splt:])),
-            'annotations' : list(map(json_data['annotations'].__getitem__, idxs[splt:])),
-        }
+    def node_annos(self, node_index):
+        """Annotation file name of the output of node `node_index`"""
+        stem, ext = os.path.splitext(self.merged_annos)
+        return f'{stem}.node-{node_index:04d}{ext}'
 
-        # write json files
+    def merge_nodes(self):
+        """
+        Combine the outputs of all `num_nodes` nodes into one dataset, once they all finished converting
+
+        The annotation entries of the nodes are concatenated in node order with new consecutive
+        image and annotation ids. Images stay in place, their file names keep the node sub directory.
+        Samples in tar shards keep their node ids in their shard records, read the shards with the
+        merged json to get the new ids, see `ShardDataset`. Entries keep the partition key
+        of their node, so `to_folds` and `split` match the partitions written during conversion.
+        Works on any node's dataset.
+
+        Nodes are independent processes, to try it locally run `convert_all` of datasets with
+        `node_index` 0 ... `num_nodes`-1 in separate processes, then merge.
+
+        **Returns**
 
-        train_dir = self.dst/'train'
-        val_dir = self.dst/'val'
+        `ConversionDataset` of the merged output, write its json with `to_json` or `to_folds`
+        """
+        merged = copy.copy(self)
+        merged.node_index, merged.num_nodes, merged.node_dir = 0, 1, ''
+        merged.new_annos = self.merged_annos
+        merged.manifest = None
+        merged.entries = AnnotationWriter(self.dst/(Path(merged.new_annos).stem + '.entries.jsonl'),
+                                          multi_prompt = self.multi_prompt)
+        merged.entries.open()
+        merged.img_idx, merged.anno_idx = 0, 0
+        for node in range(self.num_nodes):
+            path = self.dst/(Path(self.node_annos(node)).stem + '.entries.jsonl')
+            assert path.exists(), f'No output of node {node}: {path}'
+            for entry in tqdm(AnnotationWriter(path), desc = f'Merging node {node}'):
+                entry['img_ids'], entry['anno_ids'] = merged.img_idx, merged.anno_idx
+                merged.entries.write(entry)
+                merged.img_idx += 1
+                merged.anno_idx += 1
+        merged.entries.close()
+        return merged
+
+    def split(self, pct, info, licenses, categories):
+        """Split already converted data into train/valid partitions and move the images, see `partition`
 
-        train_dir.mkdir(parents = True, exist_ok = True)
-        val_dir.mkdir(parents = True, exist_ok = True)
+        **Params**
 
-        train_json_fname = train_dir/('train_'+ self.new_annos)
-        val_json_fname = val_dir/('val_'+ self.new_annos)
+        pct : percent of data to assign to valid split
 
-        for data, fname in zip([train_json, val_json],
-                               [train_json_fname, val_json_fname]):
+        info, licenses, categories : sections of the COCO-style JSON
+        """
 
-            with open(fname, 'w') as file:
-                json.dump(data, file)
+        def part(entry):
+            return self.partition(self.entry_key(entry), pct)
 
-        # construct id : fname dict
-        _, _, filenames = next(os.walk(self.dst))
-        img_idx_list = [int(f.split('_')[1]) for f in filenames if f.endswith('.jpg')]
-        idx_name_map = {idx:name for idx,name in zip(img_idx_list, filenames)}
+        # write json files
+        for name in ['train', 'val']:
+            (self.dst/name).mkdir(parents = True, exist_ok = True)
+            self.entries.write_coco(self.dst/name/(f'{name}_'+ self.new_annos), info, licenses, categories,
+                                    keep = lambda entry, name = name: part(entry) == name)
 
         # move images
-        for idx in tqdm(idxs[:splt], desc = 'Moving train images'):
-            shutil.move(self.dst/idx_name_map[idx], self.dst/f'train/{idx_name_map[idx]}')
+        for entry in tqdm(self.entries, total = len(self.entries), desc = 'Moving images'):
+            dst = self.dst/part(entry)/entry['img_names']
+            # node sub directories of merged outputs
+            dst.parent.mkdir(parents = True, exist_ok = True)
+            shutil.move(self.dst/entry['img_names'], dst)
+
+# worker process copy of the `ConversionDataset` used by `convert_all`
+_conversion_ds = None
+
+def _init_conversion_worker(ds):
+    global _conversion_ds
+    _conversion_ds = ds
+
+def _conversion_worker_crops(img_ids, cord_format, seed):
+    return [_conversion_ds.seeded_crop_img(img_id, cord_format, seed) for img_id in img_ids]
+
+# Cell
+class CropDataset(Dataset):
+    """Point-to-box dataset that samples crops directly from the source coco-style images
+
+    Every access runs the `ConversionDataset.crop_objs` crop geometry, prompt sampling, and
+    letterbox resize for one object, so each epoch sees fresh crop and prompt noise without
+    converting the dataset to disk first. Samples match `PTBDataset` samples. Objects that
+    conversion drops, because no square crop of the image fits them or the image is not
+    larger than `crop_size`, are left out. Prompts are clamped to the crop instead of dropped.
+
+    **Params**
+
+    root : path to source image dir
+
+    annos : coco-style annotation file of the source dataset
+
+    box_format : optional, format for box cord conversion
+
+    tfms : optional, image transforms
+
+    norm_chnls : optional number of img channels to normalize, required if using tfms
+
+    compact : optional, return compact samples like `PTBDataset`
+
+    crop_size : size of the square crops taken from the source images
+
+    crop_noise : percentage of possible crop size noise
+
+    img_size : size of the resized crops
+
+    box_noise : percentage of possible box noise
+
+    prompt_format : from for object prompt point creation, poly or box
+
+    decode_threads : optional number of threads decoding images in `__getitems__`, 0 to decode serially
+
+    decode_backend : optional image decode backend, see `utils.decode_image`
+    """
+
+    def __init__(self, root, annos, box_format = None, tfms = None, norm_chnls = None,
+                 compact = False, crop_size = 100, crop_noise = 0.1, img_size = 512,
+                 box_noise = 0.2, prompt_format = 'poly', decode_threads = 0,
+                 decode_backend = None):
+        self.root = root
+        self.compact = compact
+        self.tfms = tfms
+        if tfms:
+            assert norm_chnls in [3,4], 'Improper channel stats for normalization'
+        self.norm_chnls = norm_chnls
+        if box_format:
+            assert box_format in ['cntr_ofst', 'cntr_ofst_frac',
+                                  'corner_ofst_frac'], 'Improper box format'
+        self.box_format = box_format
+        assert prompt_format in ['poly', 'box'], 'Improper prompt format'
+        self.crop_size = crop_size
+        self.crop_noise = crop_noise
+        self.img_size = img_size
+        self.box_noise = box_noise
+        self.prompt_format = prompt_format
+        self.decode_threads = decode_threads
+        self.decode_backend = decode_backend
+        self._pool, self._pool_pid = None, None
+        self.load_annos(annos)
+
+    # sample building and the decode thread pool are shared with `PTBDataset`
+    _sample = PTBDataset._sample
+    _map = PTBDataset._map
+    __getstate__ = PTBDataset.__getstate__
+
+    def load_annos(self, annos):
+        """Index the non-crowd object annotations as flat arrays"""
+        with open(annos) as f:
+            data = json.load(f)
+        imgs = sorted(data['images'], key = lambda img: img['id'])
+        img_pos = {img['id']: i for i, img in enumerate(imgs)}
+        objs = [anno for anno in data['annotations']
+                if anno['iscrowd'] == 0 and anno['image_id'] in img_pos]
+        # objects `ConversionDataset` can crop, a square crop of the image fits the box
+        dims = {img['id']: (img['width'], img['height']) for img in imgs}
+        objs = [anno for anno in objs if self.crop_size < min(dims[anno['image_id']]) and
+                max(anno['bbox'][2:]) <= min(dims[anno['image_id']])]
+        if self.prompt_format == 'poly':
+            objs = [anno for anno in objs if isinstance(anno['segmentation'], list)]
+
+        self.ids = np.array([anno['id'] for anno in objs], dtype = np.int64)
+        self.img_idx = np.array([img_pos[anno['image_id']] for anno in objs], dtype = np.int64)
+        self.bbox = np.array([anno['bbox'] for anno in objs], dtype = np.float64).reshape(-1, 4)
+        self.fnames = np.array([img['file_name'] for img in imgs])
+
+        # first polygon of every object, flattened [x0, y0, x1, y1, ...]
+        polys = [anno['segmentation'][0] if self.prompt_format == 'poly' else []
+                 for anno in objs]
+        self.poly_offsets = np.zeros(len(objs) + 1, dtype = np.int64)
+        self.poly_offsets[1:] = np.cumsum([len(poly) for poly in polys])
+        self.polys = np.array([cord for poly in polys for cord in poly], dtype = np.float64)
+
+    def _read_img(self, idx):
+        return utils.decode_image(os.path.join(self.root, self.fnames[self.img_idx[idx]]),
+                                  backend = self.decode_backend)
+
+    def _load(self, idx):
+        """Take a noisy crop of object `idx`, returns the resized crop, coco box, and prompt"""
+        img = self._read_img(idx)
+        h, w = img.shape[:2]
+        xmin, ymin, boxw, boxh = self.bbox[idx]
+        box = [xmin, ymin, xmin + boxw, ymin + boxh]
+
+        # random prompt point from the object polygon or box
+        poly = self.polys[self.poly_offsets[idx]:self.poly_offsets[idx+1]]
+        anno = {'bbox': self.bbox[idx].tolist(), 'segmentation': [poly.tolist()]}
+        point = utils.get_prompt_points([anno], 1, self.prompt_format)[0][0]
+
+        assert (self.crop_size < w and self.crop_size < h), 'crop size is larger than image'
+        window = utils.crop_windows([box], w, h, crop_size = self.crop_size,
+            crop_noise = self.crop_noise, box_noise = self.box_noise)[0]
+        assert window['valid'], 'Object does not fit into a square crop, image size differs from annotations'
+        left, upper, right, lower = (float(window[f]) for f in ['left', 'upper', 'right', 'lower'])
+
+        # crop expects 4-tupple: (left, upper, right, lower)
+        img_crop = utils.crop_view(img, (left, upper, right, lower))
+        bbox = np.array([[xmin - left, ymin - upper, box[2] - left, box[3] - upper]])
+        img_resz, box_resz = utils.resize(self.img_size, img_crop, bbox)
+
+        # clip box cords to image dims
+        xmi, ymi, xma, yma = np.clip(box_resz[0], 0, self.img_size)
+
+        # prompt cords relative to the letterboxed crop
+        croph, cropw = img_crop.shape[:2]
+        scale = min(self.img_size/croph, self.img_size/cropw)
+        x_prompt = (point[0] - left)*scale + (self.img_size - cropw*scale)/2
+        y_prompt = (point[1] - upper)*scale + (self.img_size - croph*scale)/2
+        x_prompt = min(max(x_prompt, 0), self.img_size - 1)
+        y_prompt = min(max(y_prompt, 0), self.img_size - 1)
+
+        return img_resz, [xmi, ymi, xma - xmi, yma - ymi], [x_prompt, y_prompt]
+
+    def __getitem__(self, idx):
+        return self._sample(*self._load(idx))
+
+    def __getitems__(self, idxs):
+        return [self._sample(*sample) for sample in self._map(self._load, idxs)]
+
+    def __len__(self):
+        return len(self.ids)
+
+# Cell
+class ShardDataset(IterableDataset):
+    """Streaming point-to-box dataset reading tar shards written by `ShardWriter`
 
-        for idx in tqdm(idxs[splt:], desc = 'Moving val images'):
-            shutil.move(self.dst/idx_name_map[idx], self.dst/f'val/{idx_name_map[idx]}')
+    Shards are read sequentially. Their order is shuffled per epoch (same order in every
+    DataLoader worker), split across workers, and samples are mixed in a shuffle buffer.
+    Samples are built like `PTBDataset` samples.
+
+    Shards of a resumed `ConversionDataset.convert_all` can still hold samples of source images
+    that were changed or not logged before a crash, pass the output json as `annos` to read only
+    the samples it lists, with its image and annotation records.
+
+    **Params**
+
+    shards : directory with `*.tar` shards, also in its 'node-*' sub directories, or list of
+        shard paths, the directory the image file names of `annos` are relative to if given
+
+    annos : optional path to a json written by `ConversionDataset.to_json` for the shards, use
+        the json of `ConversionDataset.merge_nodes` for the merged image and annotation ids
+
+    box_format : optional, format for box cord conversion
+
+    tfms : optional, image transforms
+
+    norm_chnls : optional number of img channels to normalize, required if using tfms
+
+    compact : optional, return compact samples like `PTBDataset`
+
+    shuffle : optional, shuffle shard order and samples
+
+    shuffle_buffer : number of samples held in the shuffle buffer
+
+    seed : optional base seed, the shuffle of an epoch depends on seed and `set_epoch`
+
+    decode_backend : optional image decode backend, see `utils.decode_image`
+
+    img_size : optional, letterbox every image to this square size, defaults to the size
+        stored for native resolution crops
+
+    sample_prompt : optional, pick a random prompt for annotations with several prompt points
+    """
+
+    def __init__(self, shards, annos = None, box_format = None, tfms = None, norm_chnls = None,
+                 compact = False, shuffle = True, shuffle_buffer = 1000, seed = 0,
+                 decode_backend = None, img_size = None, sample_prompt = True):
+        # image and annotation records of the listed samples by shard and member name
+        self.members = None
+        if annos is not None:
+            self.members = self.load_annos(shards, annos)
+            shards = sorted(self.members)
+        elif isinstance(shards, (str, Path)):
+            # shards of the nodes of a conversion spread over nodes are in their node sub directories
+            shards = sorted(glob.glob(os.path.join(shards, '*.tar')) +
+                            glob.glob(os.path.join(shards, 'node-*', '*.tar')))
+        self.shards = [str(shard) for shard in shards]
+        assert len(self.shards) > 0, 'No shards found'
+        self.compact = compact
+        self.tfms = tfms
+        if tfms:
+            assert norm_chnls in [3,4], 'Improper channel stats for normalization'
+        self.norm_chnls = norm_chnls
+        if box_format:
+            assert box_format in ['cntr_ofst', 'cntr_ofst_frac',
+                                  'corner_ofst_frac'], 'Improper box format'
+        self.box_format = box_format
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.decode_backend = decode_backend
+        self.img_size = img_size
+        self.sample_prompt = sample_prompt
+        self.epoch = 0
+
+    # same sample building as the map-style dataset
+    _sample = PTBDataset._sample
+
+    @staticmethod
+    def load_annos(root, annos):
+        """Image and annotation records of a json by shard path and image member name"""
+        with open(annos) as f:
+            coco = json.load(f)
+        annotations = {anno['image_id']: anno for anno in coco['annotations']}
+        members = {}
+        for image in coco['images']:
+            shard, name = os.path.split(image['file_name'])
+            members.setdefault(os.path.join(root, shard), {})[name] = {
+                'image': image, 'annotation': annotations[image['id']]}
+        return members
+
+    def set_epoch(self, epoch):
+        """Set the epoch for the shuffle, needed with non-persistent DataLoader workers"""
+        self.epoch = epoch
+
+    def worker_shards(self):
+        """Shards read by the current DataLoader worker in this epoch"""
+        shards = list(self.shards)
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, self.epoch]).permutation(len(shards))
+            shards = [shards[i] for i in order]
+        info = get_worker_info()
+        if info is not None:
+            shards = shards[info.id::info.num_workers]
+        return shards
+
+    def read_shard(self, shard):
+        """Yield (image bytes, annotation record) pairs of a shard in order, only those of `annos` if given"""
+        members = None if self.members is None else self.members[shard]
+        with tarfile.open(shard, 'r|') as tar:
+            img_bytes, img_name = None, None
+            for member in tar:
+                if member.name.endswith('.json'):
+                    if members is None:
+                        yield img_bytes, json.loads(tar.extractfile(member).read())
+                    elif img_name in members:
+                        yield img_bytes, members[img_name]
+                    img_bytes = None
+                elif members is None or member.name in members:
+                    img_bytes, img_name = tar.extractfile(member).read(), member.name
+                else:
+                    img_bytes, img_name = None, None
+
+    def records(self):
+        """Yield (image bytes, annotation record) pairs of this worker, shuffled if `shuffle`"""
+        info = get_worker_info()
+        worker = info.id if info is not None else 0
+        rng = random.Random(f'{self.seed}-{self.epoch}-{worker}')
+        buffer = []
+        for shard in self.worker_shards():
+            for rec in self.read_shard(shard):
+                if not self.shuffle:
+                    yield rec
+                    continue
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(rec)
+                    continue
+                i = rng.randrange(len(buffer))
+                yield buffer[i]
+                buffer[i] = rec
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        for img_bytes, rec in self.records():
+            img = utils.decode_image(img_bytes, backend = self.decode_backend)
+            anno = rec['annotation']
+            box, prompt = anno['bbox'], anno['prompt']
+            if self.sample_prompt and anno.get('prompts'):
+                prompt = random.choice(anno['prompts'])
+            size = self.img_size or rec['image'].get('letterbox', {}).get('size')
+            if size and img.shape[:2] != (size, size):
+                img, box, prompt = utils.letterbox(img, size, box, prompt)
+            yield self._sample(img, box, prompt)
+        # consecutive epochs differ even without set_epoch
+        self.epoch += 1
\ No newline at end of file
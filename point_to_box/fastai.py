@@ -1,9 +1,138 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/03_fastai.ipynb (unless otherwise specified).
 
-__all__ = []
+__all__ = ['PTBBatchTransform', 'ptb_dataloaders']
 
 # Cell
 #export
 import point_to_box.utils as utils
 import point_to_box.data as ptb_data
-import point_to_box.model as ptb_model
\ No newline at end of file
+import point_to_box.model as ptb_model
+import torch
+from fastai.vision.all import ItemTransform
+from fastai.data.core import TfmdDL, DataLoaders
+
+# Cell
+class PTBBatchTransform(ItemTransform):
+    """fastai batch transform turning collated compact `PTBDataset` samples into 4-channel batches
+
+    Runs `ptb_data.build_4ch_batch` on the whole (imgs, prompts, boxes) batch, so float
+    conversion, augmentation, normalization, and the prompt channel are done once per batch
+    on the `DataLoaders` device. Decoding gives a `PTBImage` batch for `show_batch`, with the
+    normalization undone: `mean` and `std` if given, else the stats of a normalization in `tfms`,
+    e.g. `transforms.Normalize` on its own or inside a `transforms.Compose` or `nn.Sequential`.
+
+    **Params**
+
+    box_format : optional, format for box cord conversion
+
+    tfms : optional, image transforms, must accept batched [B, C, H, W] tensors
+
+    norm_chnls : optional number of img channels to normalize, required if using tfms
+
+    aug : optional `ptb_data.BatchAugment`
+
+    mean, std : optional per-channel normalization stats of `tfms`, for decoding
+    """
+    order = 0
+
+    def __init__(self, box_format = None, tfms = None, norm_chnls = None, aug = None,
+                 mean = None, std = None):
+        super().__init__()
+        if tfms:
+            assert norm_chnls in [3,4], 'Improper channel stats for normalization'
+        self.box_format = box_format
+        self.tfms = tfms
+        self.norm_chnls = norm_chnls
+        self.aug = aug
+        self.mean, self.std = mean, std
+
+    def norm_stats(self):
+        """(mean, std) the images were normalized with, (None, None) if unknown"""
+        if self.mean is not None and self.std is not None:
+            return self.mean, self.std
+        # `tfms` and, depth first, the steps of composed transforms
+        steps = [self.tfms]
+        while steps:
+            tfm = steps.pop(0)
+            mean, std = getattr(tfm, 'mean', None), getattr(tfm, 'std', None)
+            if mean is not None and std is not None:
+                return mean, std
+            children = list(tfm) if isinstance(tfm, torch.nn.Sequential) else getattr(tfm, 'transforms', [])
+            steps = list(children) + steps
+        return None, None
+
+    def encodes(self, b):
+        imgs, prompts, boxes = b
+        return ptb_data.build_4ch_batch(imgs, prompts, boxes, box_format = self.box_format,
+                                        tfms = self.tfms, norm_chnls = self.norm_chnls,
+                                        aug = self.aug)
+
+    def decodes(self, b):
+        img_4ch, target = b
+        img_4ch = img_4ch.clone()
+        # undo normalization, see `norm_stats`
+        mean, std = self.norm_stats()
+        if self.tfms and mean is not None:
+            stats = [torch.as_tensor(s, dtype = img_4ch.dtype, device = img_4ch.device).view(-1, 1, 1)
+                     for s in (mean, std)]
+            img_4ch[:,:self.norm_chnls] = img_4ch[:,:self.norm_chnls]*stats[1] + stats[0]
+        # `PTBImage.show` draws boxes in 'corner_ofst_frac'
+        imgh, imgw = img_4ch.shape[-2:]
+        boxes = target.double()
+        if self.box_format:
+            boxes = utils.revert_cords_batch(boxes, (imgw, imgh), self.box_format)
+        target = utils.convert_cords_batch(boxes, (imgw, imgh), 'corner_ofst_frac').to(target.dtype)
+        return ptb_data.PTBImage((img_4ch, target))
+
+# Cell
+def ptb_dataloaders(train_root, train_annos, valid_root, valid_annos, bs = 64,
+                    box_format = None, tfms = None, norm_chnls = None, aug = None,
+                    device = None, index_dir = None, num_workers = 0, decode_backend = None,
+                    img_size = None, **kwargs):
+    """
+    Build fastai `DataLoaders` from point-to-box datasets
+
+    Images are decoded per item as uint8, everything else runs on the whole batch in
+    `PTBBatchTransform`. `aug` is only used for the training set.
+
+    **Params**
+
+    train_root, valid_root : paths to the train and valid data dirs
+
+    train_annos, valid_annos : annotation json files
+
+    bs : batch size
+
+    box_format : optional, format for box cord conversion
+
+    tfms : optional, image transforms, must accept batched [B, C, H, W] tensors
+
+    norm_chnls : optional number of img channels to normalize, required if using tfms
+
+    aug : optional `ptb_data.BatchAugment` for the training set
+
+    device : optional device, batches are moved to it before the batch transforms
+
+    index_dir : optional cache directory for the `AnnotationIndex`
+
+    num_workers : number of DataLoader workers
+
+    decode_backend : optional image decode backend, see `utils.decode_image`
+
+    img_size : optional, letterbox every image to this square size at load time, see `ptb_data.PTBDataset`
+
+    kwargs : passed on to both `TfmdDL`s
+
+    **Returns**
+
+    fastai `DataLoaders`
+    """
+    dls = []
+    for root, annos, train in [(train_root, train_annos, True), (valid_root, valid_annos, False)]:
+        ds = ptb_data.PTBDataset(root, annos, compact = True, index_dir = index_dir,
+                                 decode_backend = decode_backend, img_size = img_size)
+        tfm = PTBBatchTransform(box_format = box_format, tfms = tfms,
+                                norm_chnls = norm_chnls, aug = aug if train else None)
+        dls.append(TfmdDL(ds, bs = bs, shuffle = train, drop_last = train, device = device,
+                          num_workers = num_workers, after_batch = [tfm], **kwargs))
+    return DataLoaders(*dls, device = device)
\ No newline at end of file
@@ -1,6 +1,6 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/02_model.ipynb (unless otherwise specified).
 
-__all__ = ['EfficientLoc', 'CIoU']
+__all__ = ['DevicePrefetcher', 'EfficientLoc', 'CIoU']
 
 # Cell
 #export
@@ -16,6 +16,110 @@ import torch.optim as opt
 from torch.utils.data import DataLoader
 from torchvision import transforms
 
+import queue
+import threading
+
+# Cell
+class DevicePrefetcher():
+    """Wraps a DataLoader and stages the next batch on the device while the current one is used
+
+    On CUDA devices host batches are pinned and copied on a side stream (double buffering),
+    otherwise a background thread keeps a queue of batches filled. The time the loop spent
+    waiting on data in the last pass is stored in `wait_time`.
+
+    **Params**
+
+    loader : DataLoader (or any iterable) of tensors or tuples/lists of tensors
+
+    device : device to move batches to
+
+    queue_size : optional number of batches the background thread prefetches on CPU hosts
+    """
+
+    def __init__(self, loader, device, queue_size = 2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.queue_size = queue_size
+        self.wait_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.wait_time = 0.
+        if self.device.type == 'cuda':
+            return self._cuda_iter()
+        return self._thread_iter()
+
+    def _to_device(self, batch, pin = False):
+        if torch.is_tensor(batch):
+            if pin and not batch.is_pinned(): batch = batch.pin_memory()
+            return batch.to(self.device, non_blocking = True)
+        batch_items = [self._to_device(b, pin) for b in batch]
+        # namedtuples take their fields as separate arguments
+        if hasattr(batch, '_fields'): return type(batch)(*batch_items)
+        return type(batch)(batch_items)
+
+    def _record(self, batch, stream):
+        if torch.is_tensor(batch): batch.record_stream(stream)
+        else:
+            for b in batch: self._record(b, stream)
+
+    def _cuda_iter(self):
+        stream = torch.cuda.Stream(self.device)
+        loader = iter(self.loader)
+
+        def stage():
+            start = time.time()
+            batch = next(loader, None)
+            self.wait_time += time.time() - start
+            if batch is None: return None
+            # copy of the next batch overlaps with compute on the current one
+            with torch.cuda.stream(stream):
+                return self._to_device(batch, pin = True)
+
+        nxt = stage()
+        while nxt is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            batch = nxt
+            self._record(batch, current)
+            nxt = stage()
+            yield batch
+
+    def _thread_iter(self):
+        batches = queue.Queue(maxsize = self.queue_size)
+        stop = threading.Event()
+        done = object()
+
+        def fill():
+            try:
+                for batch in self.loader:
+                    batch = self._to_device(batch)
+                    while not stop.is_set():
+                        try:
+                            batches.put(batch, timeout = 0.1)
+                            break
+                        except queue.Full: pass
+                    if stop.is_set(): return
+            except Exception as e:
+                if not stop.is_set(): batches.put(e)
+            if not stop.is_set(): batches.put(done)
+
+        thread = threading.Thread(target = fill, daemon = True)
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                batch = batches.get()
+                self.wait_time += time.time() - start
+                if batch is done: break
+                if isinstance(batch, Exception): raise batch
+                yield batch
+        finally:
+            # stop the producer if the loop exits early
+            stop.set()
+
 # Cell
 class EfficientLoc():
 
@@ -89,7 +193,8 @@ class EfficientLoc():
 
         return model
 
-    def train(self, dataloaders, criterion, optimizer, num_epochs, ds_sizes, print_every = 100, scheduler=None):
+    def train(self, dataloaders, criterion, optimizer, num_epochs, ds_sizes, print_every = 100, scheduler=None,
+              prefetch = False):
         """
         Training function for model
 
@@ -108,6 +213,8 @@ class EfficientLoc():
         print_every : batch_interval for intermediate loss printing
 
         scheduler : Optional learning rate scheduler
+
+        prefetch : Optional, wrap dataloaders in a `DevicePrefetcher` to overlap batch transfer with compute
         """
         train_start = time.time()
         best_model_wts = copy.deepcopy(self.model.state_dict())
@@ -130,8 +237,15 @@ class EfficientLoc():
                 running_loss = 0.
                 batches_past = 0
 
+                loader = dataloaders[phase]
+                if prefetch:
+                    loader = DevicePrefetcher(loader, self.device)
+                data_wait = 0.
+                fetch_start = time.time()
+
                 # Iterate over data.
-                for i, (inputs, labels) in enumerate(dataloaders[phase]):
+                for i, (inputs, labels) in enumerate(loader):
+                    data_wait += time.time() - fetch_start
 
                     inputs = inputs.to(self.device)
                     labels = labels.to(self.device)
@@ -159,6 +273,8 @@ class EfficientLoc():
                         inter_loss = 0.
                         batches_past = i+1
 
+                    fetch_start = time.time()
+
                 if phase == 'train' and scheduler is not None:
                     scheduler.step()
 
@@ -168,6 +284,7 @@ class EfficientLoc():
                 phase_duration = f'{(phase_duration // 60):.0f}m {(phase_duration % 60):.0f}s'
                 print('-' * 5)
                 print(f'{phase} Phase Duration: {phase_duration}  Average Loss: {epoch_loss:.6f} in ')
+                print(f'{phase} Data Wait: {data_wait:.1f}s')
                 print('-' * 5)
 
                 # deep copy the model
@@ -1,12 +1,18 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/00_utils.ipynb (unless otherwise specified).
 
-__all__ = ['get_norm_stats', 'draw_rect', 'convert_cords', 'resize', 'noise', 'get_prompt_points', 'yolo_to_coco']
+__all__ = ['get_norm_stats', 'draw_rect', 'convert_cords', 'convert_cords_batch', 'revert_cords_batch', 'resize',
+           'letterbox_params', 'letterbox', 'letterbox_batch', 'noise', 'WINDOW_DTYPE', 'crop_windows', 'crop_view',
+           'get_prompt_points', 'decode_pil', 'decode_cv2', 'decode_turbojpeg', 'decode_simplejpeg', 'DECODERS',
+           'decode_image', 'image_size', 'merge_regions', 'decode_regions', 'resize_region', 'benchmark_decoders',
+           'yolo_to_coco']
 
 # Cell
 #export
 import cv2
+import io
 import os
 import random
+import time
 from cv2 import rectangle
 import numpy as np
 from shapely.geometry import Polygon, Point
@@ -170,7 +176,93 @@ def convert_cords(cords, img_dims, cord_format):
     return [ofst[0], ofst[1], w, h]
 
 # Cell
-def resize(size, img, bbox):
+def convert_cords_batch(cords, img_dims, cord_format):
+    """
+    Convert a batch of bounding box coordinates, vectorized version of `convert_cords`
+
+    **Parameters**
+
+    cords : np.ndarray or torch tensor of bbox coordinates [N, 4] as [xmin, ymin, w, h]
+
+    img_dims : Image dimensions (w, h) shared by all boxes, or per-box dimensions [N, 2]
+
+    cord_format : Coordinate conversion format
+
+    - cnt_ofst         : [xofst, yofst, w, h]
+    - cntr_ofst_frac   : [xofst, yofst, w, h] as fraction of image width/height
+    - corner_ofst_frac : [xmin, min, w, h] as fraction of image width/height
+
+    **Returns**
+
+    Converted box coordinates [N, 4], same type and dtype as `cords`
+
+    """
+    xmin, ymin, w, h = cords[:,0], cords[:,1], cords[:,2], cords[:,3]
+    if getattr(img_dims, 'ndim', 1) == 2:
+        imgw, imgh = img_dims[:,0], img_dims[:,1]
+    else:
+        imgw, imgh = img_dims
+    cntr_x, cntr_y = xmin + (w/2), ymin + (h/2)
+
+    if cord_format == 'cntr_ofst':
+        ofst_x, ofst_y = cntr_x - imgw/2, cntr_y - imgh/2
+    elif cord_format == 'cntr_ofst_frac':
+        ofst_x = (cntr_x - imgw/2)/(imgw/2)
+        ofst_y = (cntr_y - imgh/2)/(imgh/2)
+    elif cord_format == 'corner_ofst_frac':
+        ofst_x, ofst_y = cntr_x/imgw, cntr_y/imgh
+
+    if cord_format in ['cntr_ofst_frac',
+                       'corner_ofst_frac']:
+        w, h = w/imgw, h/imgh
+
+    # copy works for both np.ndarray and torch tensors
+    out = cords * 1
+    out[:,0], out[:,1], out[:,2], out[:,3] = ofst_x, ofst_y, w, h
+    return out
+
+# Cell
+def revert_cords_batch(cords, img_dims, cord_format):
+    """
+    Convert a batch of bounding box coordinates back to [xmin, ymin, w, h], inverse of `convert_cords_batch`
+
+    **Parameters**
+
+    cords : np.ndarray or torch tensor of converted bbox coordinates [N, 4]
+
+    img_dims : Image dimensions (w, h) shared by all boxes, or per-box dimensions [N, 2]
+
+    cord_format : Coordinate format of `cords`, see `convert_cords_batch`
+
+    **Returns**
+
+    Box coordinates [N, 4] as [xmin, ymin, w, h], same type and dtype as `cords`
+
+    """
+    ofst_x, ofst_y, w, h = cords[:,0], cords[:,1], cords[:,2], cords[:,3]
+    if getattr(img_dims, 'ndim', 1) == 2:
+        imgw, imgh = img_dims[:,0], img_dims[:,1]
+    else:
+        imgw, imgh = img_dims
+
+    if cord_format == 'cntr_ofst':
+        cntr_x, cntr_y = ofst_x + imgw/2, ofst_y + imgh/2
+    elif cord_format == 'cntr_ofst_frac':
+        cntr_x = ofst_x*(imgw/2) + imgw/2
+        cntr_y = ofst_y*(imgh/2) + imgh/2
+    elif cord_format == 'corner_ofst_frac':
+        cntr_x, cntr_y = ofst_x*imgw, ofst_y*imgh
+
+    if cord_format in ['cntr_ofst_frac',
+                       'corner_ofst_frac']:
+        w, h = w*imgw, h*imgh
+
+    out = cords * 1
+    out[:,0], out[:,1], out[:,2], out[:,3] = cntr_x - w/2, cntr_y - h/2, w, h
+    return out
+
+# Cell
+def resize(size, img, bbox, out = None):
     """
     Resize an image in accordance to 'image_letter_box' function in darknet
 
@@ -182,9 +274,11 @@ def resize(size, img, bbox):
 
     bbox : np.ndarray of bounding box coordinates [xmin, ymin, xmax, ymax]
 
+    out : optional uint8 buffer [size, size, 3] the image is letterboxed into
+
     **Returns**
 
-    img : resized image as np.ndarray
+    img : resized image as np.ndarray, `out` if given
 
     bbox : resized bounding box np.ndarray [xmin, ymin, xmax, ymax]
 
@@ -192,17 +286,16 @@ def resize(size, img, bbox):
 
     img_w, img_h = img.shape[1], img.shape[0]
 
-    w, h = size, size
-    new_w = int(img_w * min(w/img_w, h/img_h))
-    new_h = int(img_h * min(w/img_w, h/img_h))
-
-    resized_image = cv2.resize(img, (new_w,new_h))
+    if out is None:
+        out = np.empty((size, size, 3), dtype = np.uint8)
+    _letterbox_into(img, out)
 
-    canvas = np.full((size, size, 3), 0)
-    canvas[(h-new_h)//2:(h-new_h)//2 + new_h,(w-new_w)//2:(w-new_w)//2 + new_w,  :] = resized_image
+    img = out
 
-    img = canvas
+    return img, _resize_box(size, img_w, img_h, bbox)
 
+def _resize_box(size, img_w, img_h, bbox):
+    """Scale and shift box cords of an `img_w` x `img_h` image in place like `resize`"""
     scale = min(size/img_h, size/img_w)
     bbox[:,:4] *= (scale)
 
@@ -216,12 +309,111 @@ def resize(size, img, bbox):
 
     bbox[:,:4] += add_matrix
 
-    img = img.astype(np.uint8)
+    return bbox
 
-    return img, bbox
+# Cell
+def letterbox_params(img_w, img_h, size):
+    """Scale and (x, y) padding that letterbox an `img_w` x `img_h` image into a square of `size`, like `resize`"""
+    scale = min(size/img_w, size/img_h)
+    new_w, new_h = int(img_w * scale), int(img_h * scale)
+    return scale, (size - new_w)//2, (size - new_h)//2
+
+def _letterbox_into(img, out):
+    """Letterbox `img` into the square uint8 buffer `out`, only the padding is zeroed, returns the params"""
+    img_h, img_w = img.shape[:2]
+    size = out.shape[0]
+    scale, pad_x, pad_y = letterbox_params(img_w, img_h, size)
+    new_w, new_h = int(img_w * scale), int(img_h * scale)
+    out[:pad_y] = 0
+    out[pad_y + new_h:] = 0
+    out[pad_y:pad_y + new_h, :pad_x] = 0
+    out[pad_y:pad_y + new_h, pad_x + new_w:] = 0
+    dst = out[pad_y:pad_y + new_h, pad_x:pad_x + new_w]
+    resized = cv2.resize(img, (new_w, new_h), dst = dst)
+    # cv2 writes into the view when it can, otherwise it returns a new array
+    if not np.shares_memory(resized, dst):
+        dst[...] = resized
+    return scale, pad_x, pad_y
+
+def letterbox(img, size, box = None, prompt = None, out = None):
+    """
+    Letterbox a uint8 image into a zero-padded square, without any float conversion
+
+    **Params**
+
+    img : uint8 np.ndarray image, shape HxWx3
+
+    size : side length of the square output image
+
+    box : optional coco box [xmin, ymin, w, h] in image pixels
+
+    prompt : optional prompt point (x, y) in image pixels
+
+    out : optional uint8 buffer [size, size, 3] to write into, e.g. a row of a batch buffer
+
+    **Returns**
+
+    img : letterboxed uint8 image [size, size, 3], `out` if given
+
+    box : box in letterboxed pixels, if given
+
+    prompt : prompt in letterboxed pixels, if given
+
+    """
+    if out is None:
+        out = np.empty((size, size, 3), dtype = np.uint8)
+    scale, pad_x, pad_y = _letterbox_into(img, out)
+
+    res = [out]
+    if box is not None:
+        xmin, ymin, boxw, boxh = box
+        res.append([xmin*scale + pad_x, ymin*scale + pad_y, boxw*scale, boxh*scale])
+    if prompt is not None:
+        res.append([prompt[0]*scale + pad_x, prompt[1]*scale + pad_y])
+    return tuple(res) if len(res) > 1 else out
+
+def letterbox_batch(imgs, size, boxes = None, prompts = None, out = None):
+    """
+    Letterbox a list of uint8 images of any size into one batch buffer, batched version of `letterbox`
+
+    **Params**
+
+    imgs : list of uint8 np.ndarray images, shape HxWx3
+
+    size : side length of the square output images
+
+    boxes : optional coco boxes [B, 4] as [xmin, ymin, w, h] in image pixels
+
+    prompts : optional prompt points [B, 2] in image pixels
+
+    out : optional uint8 buffer [B, size, size, 3], e.g. `.numpy()` of a preallocated batch tensor
+
+    **Returns**
+
+    imgs : letterboxed uint8 batch [B, size, size, 3], `out` if given
+
+    boxes : boxes [B, 4] in letterboxed pixels, if given
+
+    prompts : prompts [B, 2] in letterboxed pixels, if given
+
+    """
+    if out is None:
+        out = np.empty((len(imgs), size, size, 3), dtype = np.uint8)
+    params = np.array([_letterbox_into(img, row) for img, row in zip(imgs, out)],
+                      dtype = np.float64).reshape(-1, 3)
+    scale, pad = params[:, :1], params[:, 1:]
+
+    res = [out]
+    if boxes is not None:
+        boxes = np.asarray(boxes, dtype = np.float64).reshape(-1, 4) * scale
+        boxes[:, :2] += pad
+        res.append(boxes)
+    if prompts is not None:
+        res.append(np.asarray(prompts, dtype = np.float64).reshape(-1, 2) * scale + pad)
+    return tuple(res) if len(res) > 1 else out
 
 # Cell
-def noise(val, size, pct = 0.2):
+def noise(val, size, pct = 0.2, rng = None):
     """
     Add noise to value
 
@@ -233,6 +425,8 @@ def noise(val, size, pct = 0.2):
 
     pct :  float, percent for interval clipping
 
+    rng : optional np.random.Generator, the global numpy RNG if None
+
     **Return**
 
     noisy_val : original value with noise added
@@ -240,12 +434,124 @@ def noise(val, size, pct = 0.2):
     """
     low = -int(size * pct)
     high = int(size * pct)
-    noise = np.random.randint(low, high+1)
+    noise = (np.random.randint if rng is None else rng.integers)(low, high+1)
     noisy_val = val + noise
     return noisy_val
 
 # Cell
-def get_prompt_points(anns, n, prompt_format):
+# structured array returned by `crop_windows`
+WINDOW_DTYPE = np.dtype([('left', np.float64), ('upper', np.float64), ('right', np.float64),
+                         ('lower', np.float64), ('crop_size', np.float64), ('valid', bool)])
+
+def crop_windows(boxes, img_w, img_h, crop_size = 100, crop_noise = 0.1, box_noise = 0.05, rng = None):
+    """
+    Compute noisy square crop windows for many object boxes at once
+
+    The noise is drawn for all boxes together, from `rng` or the global numpy RNG.
+
+    **Params**
+
+    boxes : box coordinates [N, 4] as [xmin, ymin, xmax, ymax], one row per crop
+
+    img_w : width of the image the crops are taken from
+
+    img_h : height of the image the crops are taken from
+
+    crop_size : square crop size
+
+    crop_noise : percent of noise to add to crop size
+
+    box_noise : percent of noise to add to box off set
+
+    rng : optional np.random.Generator, the global numpy RNG if None
+
+    **Return**
+
+    structured array [N] of `WINDOW_DTYPE` with the crop windows (left, upper, right, lower),
+    their crop sizes, and `valid` False where the box does not fit into a crop
+
+    """
+    boxes = np.asarray(boxes, dtype = np.float64).reshape(-1, 4)
+    num = len(boxes)
+    randint = np.random.randint if rng is None else rng.integers
+    uniform = np.random.uniform if rng is None else rng.uniform
+    xmin, ymin, xmax, ymax = boxes.T
+    boxw, boxh = xmax - xmin, ymax - ymin
+    cntr_x, cntr_y = xmin + (boxw/2), ymin + (boxh/2)
+
+    # add noise to crop size
+    size_noise = int(crop_size * crop_noise)
+    sizes = crop_size + randint(-size_noise, size_noise + 1, size = num).astype(np.float64)
+
+    # crop too small, box taking up more than 90% of crop in either dimension
+    too_small = (boxw >= (sizes * 0.9)) | (boxh >= (sizes * 0.9))
+    sizes[too_small] = np.maximum(boxw, boxh)[too_small] * uniform(1.2, 1.4, too_small.sum())
+    # clip crop size to shortest img dimension
+    sizes = np.minimum(sizes, min(img_w, img_h))
+    valid = sizes >= np.maximum(boxw, boxh)
+
+    # starting crop cords
+    old_left, old_upper = cntr_x - (sizes / 2), cntr_y - (sizes / 2)
+
+    # max difference the starting crop values can be adjusted before
+    # interfering with the object box bounds
+    max_wd = (xmin - old_left) - 1
+    max_hd = (ymin - old_upper) - 1
+
+    # add noise so box isn't always exactly in the center of crop
+    ofst_noise = np.trunc(sizes * box_noise).astype(np.int64)
+    left = old_left + randint(-ofst_noise, ofst_noise + 1, size = num)
+    upper = old_upper + randint(-ofst_noise, ofst_noise + 1, size = num)
+
+    # check if noise pushed crop bounds too far relative to box bounds
+    def clamp(val, old, max_d):
+        diff = val - old
+        too_far = np.abs(diff) > max_d
+        val = np.where(too_far & (diff > 0), old + max_d, val)
+        return np.where(too_far & (diff < 0), old - max_d, val)
+    left, upper = clamp(left, old_left, max_wd), clamp(upper, old_upper, max_hd)
+
+    # check and correct for out of bounds crop
+    left, upper = np.maximum(left, 0), np.maximum(upper, 0)
+    left = np.where(left + sizes > img_w, img_w - sizes, left)
+    upper = np.where(upper + sizes > img_h, img_h - sizes, upper)
+
+    windows = np.zeros(num, dtype = WINDOW_DTYPE)
+    windows['left'], windows['upper'] = left, upper
+    windows['right'], windows['lower'] = left + sizes, upper + sizes
+    windows['crop_size'], windows['valid'] = sizes, valid
+    return windows
+
+# Cell
+def crop_view(img, box):
+    """
+    Crop an np.ndarray image exactly like `PIL.Image.crop`, without copying when possible
+
+    **Params**
+
+    img : np.ndarray image, shape HxWxC
+
+    box : crop box (left, upper, right, lower), rounded to whole pixels like Pillow does
+
+    **Return**
+
+    view into `img`, or a zero-padded copy if the box reaches outside the image
+
+    """
+    left, upper, right, lower = (int(round(cord)) for cord in box)
+    img_h, img_w = img.shape[:2]
+    if left >= 0 and upper >= 0 and right <= img_w and lower <= img_h:
+        return img[upper:lower, left:right]
+
+    # pillow fills the area outside the image with zeros
+    out = np.zeros((max(lower - upper, 0), max(right - left, 0)) + img.shape[2:], dtype = img.dtype)
+    x0, y0, x1, y1 = max(left, 0), max(upper, 0), min(right, img_w), min(lower, img_h)
+    if x1 > x0 and y1 > y0:
+        out[y0 - upper:y1 - upper, x0 - left:x1 - left] = img[y0:y1, x0:x1]
+    return out
+
+# Cell
+def get_prompt_points(anns, n, prompt_format, rng = None):
     """Get list of object prompt points by sampeling random points from the object polygon or box
 
     **Params**
@@ -256,7 +562,14 @@ def get_prompt_points(anns, n, prompt_format):
 
     prompt_format : 'poly' use segmentation info, 'box' use bbox info
 
+    rng : optional np.random.Generator, the global python and numpy RNGs if None
+
     """
+    def triangular(low, high, mode):
+        if rng is None:
+            return random.triangular(low, high, mode)
+        return rng.triangular(low, mode, high) if high > low else low
+
     ppoints = []
     for anno in anns:
         # prompt points from segmentation info
@@ -271,17 +584,17 @@ def get_prompt_points(anns, n, prompt_format):
 
                 # rand point in poly bounds
                 x_poly_cent = noise(val = xmin + (xmax - xmin)/2,
-                                   size = xmax - xmin, pct = 0.2)
+                                   size = xmax - xmin, pct = 0.2, rng = rng)
                 y_poly_cent = noise(val = ymin + (ymax - ymin)/2,
-                                   size = ymax - ymin, pct = 0.2)
+                                   size = ymax - ymin, pct = 0.2, rng = rng)
                 rand_pt = Point([x_poly_cent, y_poly_cent])
                 # check if rand_pt is in poly
                 if rand_pt.within(poly):
                     ppl.append((rand_pt.x, rand_pt.y))
                 else:
                     # rand point from triangle distribution
-                    rand_pt = Point([random.triangular(xmin, xmax, xmin + (xmax-xmin)/2),
-                                    random.triangular(ymin, ymax, ymin + (ymax-ymin)/2)])
+                    rand_pt = Point([triangular(xmin, xmax, xmin + (xmax-xmin)/2),
+                                    triangular(ymin, ymax, ymin + (ymax-ymin)/2)])
                     if rand_pt.within(poly):
                         ppl.append((rand_pt.x, rand_pt.y))
             ppoints.append(ppl)
@@ -294,15 +607,334 @@ def get_prompt_points(anns, n, prompt_format):
             # prompt point list
             ppl = []
             while len(ppl) < n:
-                x_rand = noise(val = x_cent, size = box[2], pct = 0.1)
-                y_rand = noise(val = y_cent, size = box[3], pct = 0.1)
+                x_rand = noise(val = x_cent, size = box[2], pct = 0.1, rng = rng)
+                y_rand = noise(val = y_cent, size = box[3], pct = 0.1, rng = rng)
                 ppl.append((x_rand, y_rand))
             ppoints.append(ppl)
 
     return ppoints
 
 # Cell
-def yolo_to_coco(imgs_path, lbls_path):
+def _to_out(img, out):
+    """Copy uint8 `img` into `out` if the shapes match, returns whichever holds the image"""
+    if out is None or out.shape != img.shape:
+        return img
+    np.copyto(out, img)
+    return out
+
+def _is_jpeg(data):
+    return data[:2] == b'\xff\xd8'
+
+def _read_bytes(src):
+    """Encoded image bytes from a file path or bytes"""
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return src
+    with open(src, 'rb') as f:
+        return f.read()
+
+def _open_pil(src):
+    return Image.open(io.BytesIO(src) if isinstance(src, (bytes, bytearray, memoryview)) else src)
+
+def decode_pil(path, out = None):
+    """Decode with Pillow"""
+    img = _open_pil(path)
+    if img.mode != 'RGB': img = img.convert('RGB')
+    return _to_out(np.asarray(img), out)
+
+def _decode_pil_draft(path, out = None, scale = 2):
+    """Decode with Pillow's reduced-size JPEG `draft` mode, the image is downscaled by up to `scale`
+
+    Not a `DECODERS` backend, the image no longer matches its annotations, see `benchmark_decoders`
+    """
+    img = _open_pil(path)
+    img.draft('RGB', (img.width//scale, img.height//scale))
+    if img.mode != 'RGB': img = img.convert('RGB')
+    return _to_out(np.asarray(img), out)
+
+def decode_cv2(path, out = None):
+    """Decode with `cv2.imdecode`, the BGR -> RGB conversion writes straight into `out`"""
+    if isinstance(path, str):
+        data = np.fromfile(path, dtype = np.uint8)
+    else:
+        data = np.frombuffer(path, dtype = np.uint8)
+    # keep EXIF orientation untouched like Pillow does
+    img = cv2.imdecode(data, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        raise ValueError('cv2 could not decode image')
+    if out is not None and out.shape == img.shape:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst = out)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+_turbojpeg = None
+
+def decode_turbojpeg(path, out = None):
+    """Decode with libjpeg-turbo through `PyTurboJPEG`, non-JPEG files fall back to Pillow"""
+    global _turbojpeg
+    import turbojpeg
+    data = _read_bytes(path)
+    if not _is_jpeg(data):
+        return decode_pil(data, out)
+    if _turbojpeg is None:
+        _turbojpeg = turbojpeg.TurboJPEG()
+    return _to_out(_turbojpeg.decode(data, pixel_format = turbojpeg.TJPF_RGB), out)
+
+def decode_simplejpeg(path, out = None):
+    """Decode with libjpeg-turbo through `simplejpeg`, straight into `out` when it fits"""
+    import simplejpeg
+    data = _read_bytes(path)
+    if not _is_jpeg(data):
+        return decode_pil(data, out)
+    if out is not None and out.flags['C_CONTIGUOUS']:
+        h, w = simplejpeg.decode_jpeg_header(data)[:2]
+        if out.shape == (h, w, 3):
+            simplejpeg.decode_jpeg(data, colorspace = 'RGB', buffer = out)
+            return out
+    return simplejpeg.decode_jpeg(data, colorspace = 'RGB')
+
+# name -> fn(path, out = None), returning an RGB uint8 HxWx3 np.ndarray (`out` when the
+# image was decoded into it), `path` is a file path or encoded bytes,
+# add entries to register more backends
+DECODERS = {'pil': decode_pil, 'cv2': decode_cv2,
+            'turbojpeg': decode_turbojpeg, 'simplejpeg': decode_simplejpeg}
+
+# Cell
+def decode_image(path, out = None, backend = None):
+    """
+    Decode an image file (or encoded image bytes) into an RGB uint8 array with a pluggable backend
+
+    Pixel values can differ slightly between backends (different IDCT implementations),
+    the image size is always the full size of the file.
+
+    **Params**
+
+    path : image file path or encoded image bytes
+
+    out : optional uint8 buffer [H, W, 3], filled if it matches the image shape
+
+    backend : optional name in `DECODERS` or a decode function, defaults to the
+        `PTB_DECODER` environment variable or 'pil'
+
+    **Returns**
+
+    RGB uint8 np.ndarray [H, W, 3], `out` if the image was decoded into it
+    """
+    if backend is None:
+        backend = os.environ.get('PTB_DECODER', 'pil')
+    if not callable(backend):
+        assert backend in DECODERS, f'Unknown decode backend {backend}'
+        backend = DECODERS[backend]
+    if not isinstance(path, (bytes, bytearray, memoryview)):
+        path = str(path)
+    return backend(path, out)
+
+# Cell
+# JPEG MCU (width, height) of the `PyTurboJPEG` chroma subsampling modes, TJSAMP_444 ... TJSAMP_441
+_MCU_SIZES = [(8, 8), (16, 8), (16, 16), (8, 8), (8, 16), (32, 8), (8, 32)]
+
+def _get_turbojpeg():
+    """Shared `PyTurboJPEG` decoder, None if it is not installed"""
+    global _turbojpeg
+    if _turbojpeg is None:
+        try:
+            import turbojpeg
+        except ImportError:
+            return None
+        _turbojpeg = turbojpeg.TurboJPEG()
+    return _turbojpeg
+
+def image_size(path):
+    """(width, height) of an image file or encoded image bytes, read from its header without decoding"""
+    with _open_pil(path) as img:
+        return img.size
+
+def merge_regions(boxes, gap = 0):
+    """
+    Merge overlapping regions, and regions less than `gap` pixels apart, into their union
+
+    **Params**
+
+    boxes : list of (left, upper, right, lower) regions
+
+    gap : max distance between two regions that are merged
+
+    **Returns**
+
+    list of merged regions and the index of the merged region holding each of `boxes`
+    """
+    merged = [list(box) for box in boxes]
+    owner = list(range(len(boxes)))
+    changed = True
+    # a union can reach regions its parts did not, repeat until nothing changes
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                a, b = merged[i], merged[j]
+                if a is None or b is None:
+                    continue
+                if a[0] <= b[2] + gap and b[0] <= a[2] + gap and a[1] <= b[3] + gap and b[1] <= a[3] + gap:
+                    merged[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    merged[j] = None
+                    owner = [i if k == j else k for k in owner]
+                    changed = True
+    keep = [i for i, box in enumerate(merged) if box is not None]
+    new_idx = {i: k for k, i in enumerate(keep)}
+    return [tuple(merged[i]) for i in keep], [new_idx[k] for k in owner]
+
+def decode_regions(path, boxes = None, scale = 1, backend = None):
+    """
+    Decode only the given regions of an image, optionally at a reduced scale
+
+    With the 'turbojpeg' backend JPEGs are cut losslessly to the regions, widened to the MCU
+    grid, and decoded with libjpeg-turbo's DCT scaling, so pixels outside the regions are never
+    decoded. The Pillow backends decode the whole image, using Pillow's reduced-size JPEG `draft`
+    mode for `scale`. Other backends, and subsampling modes without a known MCU size, decode
+    the whole image at full size. Every region is the full image if it was decoded whole.
+
+    **Params**
+
+    path : image file path or encoded image bytes
+
+    boxes : optional list of (left, upper, right, lower) regions in full resolution pixels,
+        one region covering the whole image if None
+
+    scale : requested downscale factor, 1, 2, 4 or 8
+
+    backend : optional name in `DECODERS` or a decode function, see `decode_image`
+
+    **Returns**
+
+    list of (img, left, upper) per region, RGB uint8 np.ndarray [H, W, 3] covering at least the
+    region and the full resolution cords of its upper left corner, and the downscale factor
+    the regions were decoded at (1 for formats without reduced-size decoding)
+    """
+    assert scale in [1, 2, 4, 8], 'Improper decode scale'
+    if backend is None:
+        backend = os.environ.get('PTB_DECODER', 'pil')
+    data = _read_bytes(path)
+    num = 1 if boxes is None else len(boxes)
+    jpeg = _get_turbojpeg() if backend == 'turbojpeg' and _is_jpeg(data) else None
+
+    if jpeg is None:
+        # the decoders without region or scaled decoding
+        if scale == 1 or backend != 'pil':
+            return [(decode_image(data, backend = backend), 0, 0)] * num, 1
+        img = _open_pil(data)
+        full_w = img.width
+        if scale > 1:
+            img.draft('RGB', (img.width//scale, img.height//scale))
+        if img.mode != 'RGB': img = img.convert('RGB')
+        img = np.asarray(img)
+        # scaled JPEG decoding rounds sizes up, draft may pick a smaller scale
+        scale = next(s for s in [8, 4, 2, 1] if s <= scale and -(-full_w // s) == img.shape[1])
+        return [(img, 0, 0)] * num, scale
+
+    import turbojpeg
+    scaling = None if scale == 1 else (1, scale)
+    img_w, img_h, subsample, _ = jpeg.decode_header(data)
+    # grayscale (TJSAMP_GRAY) has 8x8 MCUs, unknown modes are decoded whole
+    if boxes is None or not 0 <= subsample < len(_MCU_SIZES):
+        return [(jpeg.decode(data, pixel_format = turbojpeg.TJPF_RGB, scaling_factor = scaling), 0, 0)] * num, scale
+
+    mcu_w, mcu_h = _MCU_SIZES[subsample]
+    regions = []
+    for left, upper, right, lower in boxes:
+        # lossless crops start on the MCU grid
+        x = max(int(left), 0) // mcu_w * mcu_w
+        y = max(int(upper), 0) // mcu_h * mcu_h
+        w = min(int(np.ceil(right)), img_w) - x
+        h = min(int(np.ceil(lower)), img_h) - y
+        region = jpeg.decode(jpeg.crop(data, x, y, w, h), pixel_format = turbojpeg.TJPF_RGB,
+                             scaling_factor = scaling)
+        regions.append((region, x, y))
+    return regions, scale
+
+def resize_region(size, region, box, bbox, left = 0, upper = 0, scale = 1):
+    """
+    `resize` of the full resolution crop `box`, resampled straight from a region decoded at 1/`scale`
+
+    The region is sampled where `cv2.resize` samples the full resolution crop, so the output
+    differs from cropping and resizing the full image only by the low-pass filter of the
+    reduced-scale decoding, and the box cords are the same.
+
+    **Params**
+
+    size : target size for the long-edge of the crop
+
+    region : RGB uint8 np.ndarray decoded at 1/`scale`, see `decode_regions`
+
+    box : crop box (left, upper, right, lower) in full resolution pixels, rounded like `crop_view`
+
+    bbox : np.ndarray of bounding box coordinates [xmin, ymin, xmax, ymax] relative to the crop
+
+    left, upper : full resolution cords of the upper left corner of `region`
+
+    scale : downscale factor `region` was decoded at
+
+    **Returns**
+
+    img : letterboxed crop, uint8 np.ndarray [size, size, 3]
+
+    bbox : resized bounding box np.ndarray [xmin, ymin, xmax, ymax]
+    """
+    crop_left, crop_upper, crop_right, crop_lower = (int(round(cord)) for cord in box)
+    crop_w, crop_h = crop_right - crop_left, crop_lower - crop_upper
+    lb_scale, pad_x, pad_y = letterbox_params(crop_w, crop_h, size)
+    new_w, new_h = int(crop_w * lb_scale), int(crop_h * lb_scale)
+
+    # output pixel d samples crop pixel (d + 0.5) * step - 0.5 like cv2.resize, and region
+    # pixel j is centered on full resolution pixel left + (j + 0.5) * scale - 0.5
+    step_x, step_y = crop_w / new_w, crop_h / new_h
+    mat = np.array([[step_x / scale, 0, (crop_left - left + 0.5 * step_x) / scale - 0.5],
+                    [0, step_y / scale, (crop_upper - upper + 0.5 * step_y) / scale - 0.5]])
+    out = np.zeros((size, size, 3), dtype = np.uint8)
+    out[pad_y:pad_y + new_h, pad_x:pad_x + new_w] = cv2.warpAffine(
+        region, mat, (new_w, new_h), flags = cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+        borderMode = cv2.BORDER_CONSTANT)
+    return out, _resize_box(size, crop_w, crop_h, bbox)
+
+# Cell
+def benchmark_decoders(paths, backends = None, repeat = 1, into_buffer = False):
+    """
+    Measure decode throughput of each backend on a list of image files
+
+    **Params**
+
+    paths : list of image file paths
+
+    backends : optional list of names in `DECODERS` or 'pil_draft' (Pillow's reduced-size JPEG
+        decoding, for comparison only), defaults to all of them
+
+    repeat : number of passes over `paths` per backend
+
+    into_buffer : decode into a reused buffer where the backend allows it
+
+    **Returns**
+
+    dict of backend name -> images/s, None for backends that are not available
+    """
+    paths = [str(p) for p in paths]
+    decoders = {**DECODERS, 'pil_draft': _decode_pil_draft}
+    results = {}
+    for name in backends or list(decoders):
+        backend = decoders[name]
+        # untimed warm-up pass, also allocates the output buffers
+        try:
+            imgs = [decode_image(p, backend = backend) for p in paths]
+        except (ImportError, OSError, RuntimeError):
+            # missing python package or native library
+            results[name] = None
+            continue
+        bufs = [np.empty_like(img) if into_buffer else None for img in imgs]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for p, buf in zip(paths, bufs):
+                decode_image(p, out = buf, backend = backend)
+        results[name] = repeat*len(paths)/(time.perf_counter() - start)
+    return results
+
+# Cell
+def yolo_to_coco(imgs_path, lbls_path, decode_backend = None):
     """
     Convert multiple yolo .txt annotations into a single coco-style json
 
@@ -312,6 +944,8 @@ def yolo_to_coco(imgs_path, lbls_path):
 
     lbls_path : path to annotation directory containing .txt files
 
+    decode_backend : optional image decode backend, see `decode_image`
+
     """
 
     # list of annotations
@@ -338,7 +972,7 @@ def yolo_to_coco(imgs_path, lbls_path):
     # loop over each image and annotation file
     for img_file, anno_file in zip(imgs, annos):
 
-        img = np.asarray(Image.open(imgs_path/img_file))
+        img = decode_image(imgs_path/img_file, backend = decode_backend)
         h, w = img.shape[:2]
 
         images.append({